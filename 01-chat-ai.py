@@ -14,6 +14,7 @@ Verwendung:
 Parameter:
 --model: Das zu verwendende Sprachmodell (Standard: llama3.1)
 --temperature: Die Temperatur für die Modellantworten (Standard: 0.8)
+--max_turns: Anzahl der letzten Gesprächsrunden, die als Kontext gesendet werden (Standard: 20)
 -v, --verbose: Aktiviert den Debug-Modus, um zusätzliche Informationen anzuzeigen.
 
 Beispiel:
@@ -22,7 +23,9 @@ Beispiel:
 
 import argparse
 import sys
+from collections import deque
 import os
+import uuid
 from openai import OpenAI
 
 client = OpenAI(
@@ -30,6 +33,10 @@ client = OpenAI(
     base_url = "https://chat-ai.academiccloud.de/v1"
 )
 
+# Feste Sitzungs-ID, damit alle Anfragen dieser Sitzung auf demselben Server
+# landen und dessen Prefix-Cache für die bisherige Unterhaltung nutzen können
+session_id = f"ses_{uuid.uuid4().hex}"
+
 # Kommandozeilenargumente für Modell und Temperatur parsen
 parser = argparse.ArgumentParser(
     description="Einfacher Chat mit einem lokalen Sprachmodell")
@@ -37,36 +44,45 @@ parser.add_argument("--model", type=str, default="meta-llama-3.1-8b-instruct",
                     help="Das zu verwendende Sprachmodell (Standard: meta-llama-3.1-8b-instruct)")
 parser.add_argument("--temperature", type=float, default=0.8,
                     help="Die Temperatur für die Modellantworten (Standard: 0.8)")
+parser.add_argument("--max_turns", type=int, default=20,
+                    help="Anzahl der letzten Gesprächsrunden im Kontext (Standard: 20)")
 parser.add_argument("-v", "--verbose", action="store_true",
                     help="Aktiviere den Debug-Modus")
 args = parser.parse_args()
 
-def runQuery(model, prompt="Test", options={}):
-    result = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
+# Anfrage an das Modell senden und die Antwort stückweise (Streaming) liefern
+def runQuery(model, messages=[{"role": "user", "content": "Test"}], options={}):
+    stream = client.chat.completions.create(
+        messages=messages,
         model=model,
-    ) 
-    return result.choices[0].message.content
+        stream=True,
+        extra_body={"prompt_cache_key": session_id},
+        extra_headers={"x-session-affinity": session_id},
+        **options
+    )
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
 
 # Modell vorladen durch Senden einer leeren Anfrage
 print(f"Sie werden gleich mit {args.model} chatten.")
 print("Bitte warten Sie, während das Modell geladen wird...")
 
 try:
-    response = runQuery(model=args.model)
+    response = "".join(runQuery(model=args.model))
 except Exception as e:
     print(f"Fehler beim Laden des Modells: {e}")
     sys.exit(1)
 
-# Konversationshistorie initialisieren
-conversation_history = "Assistant: Hallo, wie kann ich Ihnen helfen?\n\n"
+# Konversationshistorie als Liste von Chat-Nachrichten initialisieren; die
+# Systemnachricht bleibt fest, von den Gesprächsrunden werden nur die letzten
+# max_turns behalten (gleitendes Fenster)
+system_message = {"role": "system",
+                  "content": "Du bist ein hilfreicher Assistent. Antworte in der Sprache des Nutzers."}
+turns = deque(maxlen=2 * args.max_turns)
 
-# Begrüßung ausgeben
+# Begrüßung nur lokal ausgeben; sie wird nicht an das Modell gesendet, da
+# manche Chat-Vorlagen einen Verlauf ablehnen, der mit dem Assistenten beginnt
 print(f"\n{args.model}: Hallo, wie kann ich Ihnen helfen?\n")
 
 # Chat-Schleife
@@ -81,38 +97,36 @@ while True:
         print("Auf Wiedersehen!")
         break
 
-    # Prompt-Vorlage definieren
-    prompt = f"""
-{conversation_history}
-User: {user_query}
-
-Assistant:
-"""
+    # Neue Nachricht an die bisherige Historie anhängen
+    user_message = {"role": "user", "content": user_query}
+    request_messages = [system_message] + list(turns) + [user_message]
 
     if args.verbose:
-        print("\nDebug: Generierter Prompt:")
-        print(prompt)
+        print("\nDebug: Gesendete Nachrichten:")
+        print(request_messages)
 
-    # Antwort generieren mit dem angegebenen Modell und Temperatur
+    # Antwort mit dem angegebenen Modell und Temperatur generieren und
+    # Tokens direkt ausgeben, sobald sie eintreffen (Streaming)
+    print(f"\n{args.model}: ", end="", flush=True)
+    response_parts = []
     try:
-        response = runQuery(prompt=prompt, model=args.model,
-                                   options={'temperature': args.temperature})
+        for delta in runQuery(messages=request_messages, model=args.model,
+                              options={'temperature': args.temperature}):
+            sys.stdout.write(delta)
+            sys.stdout.flush()
+            response_parts.append(delta)
     except Exception as e:
-        print(f"Fehler bei der Generierung der Antwort: {e}")
+        print(f"\nFehler bei der Generierung der Antwort: {e}")
         continue
+    print("\n")
 
-    # Antwort extrahieren und leere Zeilen entfernen
-    assistant_response = response
-    non_blank_lines = [line for line in assistant_response.splitlines()
-                       if line.strip()]
+    # Antwort zusammensetzen
+    assistant_response = "".join(response_parts)
 
     if args.verbose:
-        print("\nDebug: Antwort vom Modell:")
+        print("Debug: Antwort vom Modell:")
         print(assistant_response)
 
-    # Antwort ausgeben
-    output = '\n'.join(non_blank_lines)  # Antwort vorbereiten
-    print(f"\n{args.model}: {output}\n")
-
     # Konversationshistorie aktualisieren
-    conversation_history += f"User: {user_query}\n\nAssistant: {assistant_response}\n\n"
\ No newline at end of file
+    turns.append(user_message)
+    turns.append({"role": "assistant", "content": assistant_response})
\ No newline at end of file
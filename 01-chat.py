@@ -14,6 +14,7 @@ Verwendung:
 Parameter:
 --model: Das zu verwendende Sprachmodell (Standard: llama3.1)
 --temperature: Die Temperatur für die Modellantworten (Standard: 0.8)
+--max_turns: Anzahl der letzten Gesprächsrunden, die als Kontext gesendet werden (Standard: 20)
 -v, --verbose: Aktiviert den Debug-Modus, um zusätzliche Informationen anzuzeigen.
 
 Beispiel:
@@ -22,6 +23,7 @@ Beispiel:
 
 import argparse
 import sys
+from collections import deque
 import ollama
 
 # Kommandozeilenargumente für Modell und Temperatur parsen
@@ -31,6 +33,8 @@ parser.add_argument("--model", type=str, default="llama3.1",
                     help="Das zu verwendende Sprachmodell (Standard: llama3.1)")
 parser.add_argument("--temperature", type=float, default=0.8,
                     help="Die Temperatur für die Modellantworten (Standard: 0.8)")
+parser.add_argument("--max_turns", type=int, default=20,
+                    help="Anzahl der letzten Gesprächsrunden im Kontext (Standard: 20)")
 parser.add_argument("-v", "--verbose", action="store_true",
                     help="Aktiviere den Debug-Modus")
 args = parser.parse_args()
@@ -48,10 +52,15 @@ except Exception as e:
     print(f"Fehler beim Laden des Modells: {e}")
     sys.exit(1)
 
-# Konversationshistorie initialisieren
-conversation_history = "Assistant: Hallo, wie kann ich Ihnen helfen?\n\n"
+# Konversationshistorie als Liste von Chat-Nachrichten initialisieren; die
+# Systemnachricht bleibt fest, von den Gesprächsrunden werden nur die letzten
+# max_turns behalten (gleitendes Fenster)
+system_message = {"role": "system",
+                  "content": "Du bist ein hilfreicher Assistent. Antworte in der Sprache des Nutzers."}
+turns = deque(maxlen=2 * args.max_turns)
 
-# Begrüßung ausgeben
+# Begrüßung nur lokal ausgeben; sie wird nicht an das Modell gesendet, da
+# manche Chat-Vorlagen einen Verlauf ablehnen, der mit dem Assistenten beginnt
 print(f"\n{args.model}: Hallo, wie kann ich Ihnen helfen?\n")
 
 # Chat-Schleife
@@ -66,38 +75,36 @@ while True:
         print("Auf Wiedersehen!")
         break
 
-    # Prompt-Vorlage definieren
-    prompt = f"""
-{conversation_history}
-User: {user_query}
-
-Assistant:
-"""
+    # Neue Nachricht an die bisherige Historie anhängen
+    user_message = {"role": "user", "content": user_query}
+    request_messages = [system_message] + list(turns) + [user_message]
 
     if args.verbose:
-        print("\nDebug: Generierter Prompt:")
-        print(prompt)
+        print("\nDebug: Gesendete Nachrichten:")
+        print(request_messages)
 
-    # Antwort generieren mit dem angegebenen Modell und Temperatur
+    # Antwort mit dem angegebenen Modell und Temperatur generieren und
+    # Tokens direkt ausgeben, sobald sie eintreffen (Streaming)
+    print(f"\n{args.model}: ", end="", flush=True)
+    response_parts = []
     try:
-        response = client.generate(prompt=prompt, model=args.model,
-                                   options={'temperature': args.temperature})
+        for part in client.chat(messages=request_messages, model=args.model, stream=True,
+                                options={'temperature': args.temperature}):
+            chunk = part['message']['content']
+            print(chunk, end="", flush=True)
+            response_parts.append(chunk)
     except Exception as e:
-        print(f"Fehler bei der Generierung der Antwort: {e}")
+        print(f"\nFehler bei der Generierung der Antwort: {e}")
         continue
+    print("\n")
 
-    # Antwort extrahieren und leere Zeilen entfernen
-    assistant_response = response.get('response', '')
-    non_blank_lines = [line for line in assistant_response.splitlines()
-                       if line.strip()]
+    # Antwort zusammensetzen
+    assistant_response = "".join(response_parts)
 
     if args.verbose:
-        print("\nDebug: Antwort vom Modell:")
+        print("Debug: Antwort vom Modell:")
         print(assistant_response)
 
-    # Antwort ausgeben
-    output = '\n'.join(non_blank_lines)  # Antwort vorbereiten
-    print(f"\n{args.model}: {output}\n")
-
     # Konversationshistorie aktualisieren
-    conversation_history += f"User: {user_query}\n\nAssistant: {assistant_response}\n\n"
\ No newline at end of file
+    turns.append(user_message)
+    turns.append({"role": "assistant", "content": assistant_response})
\ No newline at end of file
@@ -12,30 +12,111 @@ Sprachmodell, die Sprache der Antworten, die Temperatur des Modells und das
 Kontextfenster für die Textverarbeitung. Mit dem Flag `-v` oder `--verbose`
 können zusätzliche Debugging-Informationen ausgegeben werden.
 
-Das Skript verwendet Apache Tika zum Extrahieren von Text aus PDFs und Ollama als
+Das Skript verwendet PyMuPDF zum Extrahieren von Text aus PDFs und Ollama als
 Client für das Sprachmodell. Es wurde eine robuste Fehlerbehandlung
 implementiert, um sicherzustellen, dass der Benutzer bei Fehlern verständliche
-Fehlermeldungen erhält.
+Fehlermeldungen erhält. Extrahierter Text und Zusammenfassung werden unter
+~/.cache/chat-pdf zwischengespeichert, sodass ein erneuter Aufruf mit derselben
+PDF-Datei und denselben Parametern ohne erneute Zusammenfassung startet.
+
+Mit `--questions fragen.txt` werden alle Fragen aus der Datei (eine pro Zeile)
+gleichzeitig an das Modell gesendet und beantwortet, statt einen interaktiven
+Chat zu starten.
 
 Verwendung:
 ./chat-pdf.py myDoc.pdf --model llama3.1 --language deutsch --temperature 0.8
 """
 
 import argparse
+import asyncio
+import hashlib
+import json
 import os
-import ollama
-from tika import parser
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Anzahl der Seiten, die ein Thread am Stück liest
+PAGES_PER_TASK = 8
 
-# Funktion zum Extrahieren von Text aus einer PDF-Datei
-def extract_text_from_pdf(pdf_path):
+# Funktion zum Extrahieren des Textes eines Seitenbereichs; jeder Thread öffnet
+# das Dokument selbst, da fitz-Dokumente nicht threadsicher sind
+def extract_page_range(pdf_path, start, stop):
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return "".join(doc.load_page(i).get_text("text") for i in range(start, stop))
+
+# Funktion zum Extrahieren von Text aus einer PDF-Datei; die Seiten werden
+# parallel gelesen, und sobald max_chars überschritten sind, werden die
+# restlichen Seiten nicht mehr gelesen
+def extract_text_from_pdf(pdf_path, max_chars=None):
+    import fitz
     try:
-        parsed = parser.from_file(pdf_path)
-        text = parsed["content"]
-        return text
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+        page_ranges = [(start, min(start + PAGES_PER_TASK, page_count))
+                       for start in range(0, page_count, PAGES_PER_TASK)]
+        workers = os.cpu_count() or 1
+
+        parts = []
+        total_chars = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Seitenbereiche in Runden zu je 'workers' Bereichen verarbeiten
+            for i in range(0, len(page_ranges), workers):
+                texts = executor.map(lambda r: extract_page_range(pdf_path, *r),
+                                     page_ranges[i:i + workers])
+                for text in texts:
+                    parts.append(text)
+                    total_chars += len(text)
+                if max_chars is not None and total_chars > max_chars:
+                    break
+        return "".join(parts)
     except Exception as e:
         print(f"Fehler beim Lesen der PDF-Datei '{pdf_path}': {e}")
         exit(1)
 
+# Funktion zum Kürzen eines Textes auf eine maximale Anzahl von Tokens
+def truncate_to_tokens(text, max_tokens):
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text, len(tokens), False
+    return encoding.decode(tokens[:max_tokens]), max_tokens, True
+
+# Funktion zum Bestimmen der Cache-Datei für eine PDF-Datei und die gewählten Parameter
+def get_cache_path(pdf_path, model, language, context_window, context_tokens=None,
+                   summary_prompt=None):
+    with open(pdf_path, 'rb') as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+    key = f"{file_hash}-{model}-{language}-{context_window}-{context_tokens}-{summary_prompt}"
+    cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "chat-pdf")
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+# Funktion zum Laden von Text und Zusammenfassung aus dem Cache
+def load_cache(cache_path):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        return cached["text"], cached["summary"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+# Funktion zum Speichern von Text und Zusammenfassung im Cache
+def save_cache(cache_path, text, summary):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({"text": text, "summary": summary}, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"Warnung: Cache-Datei '{cache_path}' konnte nicht geschrieben werden: {e}")
+
+# Wie lange Ollama das Modell (samt KV-Cache des Dokument-Präfixes) nach
+# einer Anfrage im Speicher hält
+KEEP_ALIVE = "30m"
+
+# Maximale Anzahl zwischengespeicherter Antworten auf wiederholte Fragen
+RESPONSE_CACHE_SIZE = 256
+
 # Funktion zum Entfernen leerer Zeilen aus einem Text
 def remove_blank_lines(text):
     if text:
@@ -48,13 +129,35 @@ def remove_blank_lines(text):
 def summarize_text(client, model, summary_prompt):
     try:
         response = client.generate(
-            prompt=summary_prompt, model=model, options={'temperature': 0}
+            prompt=summary_prompt, model=model, options={'temperature': 0},
+            keep_alive=KEEP_ALIVE
         )
         return remove_blank_lines(response['response'])
     except Exception as e:
         print(f"Fehler bei der Zusammenfassung des Textes: {e}")
         exit(1)
 
+# Funktion zum Erstellen des Ollama-Clients; ollama wird wie fitz erst in der
+# Funktion importiert, damit z.B. --help sofort antwortet
+def create_client():
+    import ollama
+    return ollama.Client()
+
+# Funktion zum gleichzeitigen Beantworten mehrerer Fragen; die Anfragen werden
+# parallel gesendet, sodass der Server sie gemeinsam verarbeiten kann
+async def answer_questions(model, system_message, questions, temperature):
+    import ollama
+    async_client = ollama.AsyncClient()
+
+    async def ask(question):
+        response = await async_client.chat(
+            messages=[system_message, {"role": "user", "content": question}],
+            model=model, options={'temperature': temperature}, keep_alive=KEEP_ALIVE
+        )
+        return remove_blank_lines(response['message']['content'])
+
+    return await asyncio.gather(*(ask(q) for q in questions), return_exceptions=True)
+
 # Kommandozeilenargumente für PDF-Pfad, Modell, Sprache, Temperatur, Kontextfenster und verbose
 arg_parser = argparse.ArgumentParser(
     description="Interagiere mit einer PDF-Datei mittels eines lokalen Sprachmodells"
@@ -68,10 +171,18 @@ arg_parser.add_argument("--temperature", type=float, default=0.8,
                     help="Die Temperatur für Modellantworten (Standard: 0.8)")
 arg_parser.add_argument("--context_window", type=int, default=120000,
                     help="Maximale Anzahl von Zeichen aus dem PDF-Inhalt (Standard: 120000)")
+arg_parser.add_argument("--context_tokens", type=int, default=None,
+                    help="Maximale Anzahl von Tokens aus dem PDF-Inhalt. Falls angegeben, "
+                         "wird statt nach Zeichen nach Tokens gekürzt.")
 arg_parser.add_argument("--summary_prompt", type=str, default=None,
                     help="Der Prompt, der für die Zusammenfassung verwendet wird.")
 arg_parser.add_argument("--system_prompt", type=str, default=None,
                     help="Der System-Prompt für die Unterhaltung (Standardwert wird verwendet, falls nicht angegeben).")
+arg_parser.add_argument("--max_turns", type=int, default=20,
+                    help="Anzahl der letzten Gesprächsrunden im Kontext (Standard: 20)")
+arg_parser.add_argument("--questions", type=str, default=None,
+                    help="Datei mit einer Frage pro Zeile. Die Fragen werden gleichzeitig "
+                         "beantwortet, anschließend endet das Skript.")
 arg_parser.add_argument("-v", "--verbose", action="store_true",
                     help="Aktiviere ausführliche Ausgabe für Debugging")
 args = arg_parser.parse_args()
@@ -80,43 +191,72 @@ args = arg_parser.parse_args()
 pdf_name = os.path.basename(args.pdf_path)
 print(f"Lade Modell {args.model} und verarbeite {pdf_name}. Dies kann etwas dauern.")
 
-# Text aus der PDF extrahieren
-if args.verbose:
-    print("Extrahiere Text aus der PDF-Datei...")
-pdf_text = extract_text_from_pdf(args.pdf_path)
-
-# Inhalt kürzen, falls er das Kontextfenster überschreitet
-if len(pdf_text) > args.context_window:
-    pdf_text = pdf_text[:args.context_window]
-    print("Der Inhalt der PDF-Datei wurde gekürzt, um in das Kontextfenster "
-          "des Modells zu passen.")
-elif args.verbose:
-    print(f"Der gesamte Text passt in das Kontextfenster ({len(pdf_text)} Zeichen).")
-
 # Ollama-Client initialisieren
 try:
-    client = ollama.Client()
+    client = create_client()
 except Exception as e:
     print(f"Fehler beim Initialisieren des Ollama-Clients: {e}")
     exit(1)
 
-# Zusammenfassungsprompt vorbereiten
-if args.summary_prompt:
-    try:
-        summary_prompt = args.summary_prompt.format(language=args.language, text=pdf_text)
-    except KeyError as e:
-        print(f"Fehler: Platzhalter {e} in summary_prompt nicht gefunden.")
-        exit(1)
+# Text und Zusammenfassung aus dem Cache laden, falls die PDF-Datei mit
+# denselben Parametern bereits verarbeitet wurde
+try:
+    cache_path = get_cache_path(args.pdf_path, args.model, args.language,
+                                args.context_window, args.context_tokens,
+                                args.summary_prompt)
+except OSError as e:
+    print(f"Fehler beim Lesen der PDF-Datei '{args.pdf_path}': {e}")
+    exit(1)
+cached = load_cache(cache_path)
+
+if cached:
+    pdf_text, pdf_summary = cached
+    if args.verbose:
+        print(f"Text und Zusammenfassung aus dem Cache geladen ({cache_path}).")
 else:
-    summary_prompt = (
-        f"Summarize the following text in {args.language}. "
-        f"Two paragraphs will be enough:\n\n{pdf_text}\n\nSummary:"
-    )
+    # Text aus der PDF extrahieren
+    if args.verbose:
+        print("Extrahiere Text aus der PDF-Datei...")
+    if args.context_tokens:
+        pdf_text = extract_text_from_pdf(args.pdf_path)
+    else:
+        pdf_text = extract_text_from_pdf(args.pdf_path, args.context_window)
 
-# PDF-Text zusammenfassen
-if args.verbose:
-    print("Fasse den Text zusammen...")
-pdf_summary = summarize_text(client, args.model, summary_prompt)
+    # Inhalt kürzen, falls er das Kontextfenster überschreitet
+    if args.context_tokens:
+        pdf_text, token_count, truncated = truncate_to_tokens(pdf_text, args.context_tokens)
+        if truncated:
+            print("Der Inhalt der PDF-Datei wurde gekürzt, um in das Kontextfenster "
+                  "des Modells zu passen.")
+        elif args.verbose:
+            print(f"Der gesamte Text passt in das Kontextfenster ({token_count} Tokens).")
+    elif len(pdf_text) > args.context_window:
+        pdf_text = pdf_text[:args.context_window]
+        print("Der Inhalt der PDF-Datei wurde gekürzt, um in das Kontextfenster "
+              "des Modells zu passen.")
+    elif args.verbose:
+        print(f"Der gesamte Text passt in das Kontextfenster ({len(pdf_text)} Zeichen).")
+
+    # Zusammenfassungsprompt vorbereiten
+    if args.summary_prompt:
+        try:
+            summary_prompt = args.summary_prompt.format(language=args.language, text=pdf_text)
+        except KeyError as e:
+            print(f"Fehler: Platzhalter {e} in summary_prompt nicht gefunden.")
+            exit(1)
+    else:
+        summary_prompt = (
+            f"Summarize the following text in {args.language}. "
+            f"Two paragraphs will be enough:\n\n{pdf_text}\n\nSummary:"
+        )
+
+    # PDF-Text zusammenfassen
+    if args.verbose:
+        print("Fasse den Text zusammen...")
+    pdf_summary = summarize_text(client, args.model, summary_prompt)
+
+    # Ergebnis für spätere Aufrufe speichern
+    save_cache(cache_path, pdf_text, pdf_summary)
 
 # Zusammenfassung dem Benutzer anzeigen
 print(f"{pdf_summary}\n")
@@ -124,18 +264,50 @@ print(f"{pdf_summary}\n")
 # System-Prompt vorbereiten
 if args.system_prompt:
     try:
-        conversation_history = args.system_prompt.format(text=pdf_text)
+        system_prompt = args.system_prompt.format(text=pdf_text)
     except KeyError as e:
         print(f"Fehler: Platzhalter {e} in system_prompt nicht gefunden.")
         exit(1)
 else:
-    conversation_history = (
+    system_prompt = (
         f"You are a helpful assistant and inform the user about the following document:\n\n"
         f"{pdf_text}\n\nNow take the user's question."
     )
+
+# Konversationsverlauf als Liste von Chat-Nachrichten; der System-Prompt mit
+# dem PDF-Text steht als unveränderlicher Präfix am Anfang, von den
+# Gesprächsrunden werden nur die letzten max_turns behalten
+system_message = {"role": "system", "content": system_prompt}
+turns = deque(maxlen=2 * args.max_turns)
 if args.verbose:
     print("Konversationsverlauf initialisiert.")
 
+# Stapelverarbeitung: alle Fragen aus der Datei gleichzeitig beantworten
+if args.questions:
+    try:
+        with open(args.questions, 'r', encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        print(f"Fehler beim Lesen der Fragen-Datei '{args.questions}': {e}")
+        exit(1)
+
+    if args.verbose:
+        print(f"Beantworte {len(questions)} Fragen gleichzeitig...")
+    answers = asyncio.run(answer_questions(args.model, system_message, questions,
+                                           args.temperature))
+    for question, answer in zip(questions, answers):
+        print(f"Du fragst: {question}")
+        if isinstance(answer, Exception):
+            print(f"Fehler beim Generieren der Antwort: {answer}\n")
+        else:
+            print(f"\n{args.model}: {answer}\n")
+    exit(0)
+
+# Antworten auf bereits gestellte Fragen zum Dokument (LRU-Cache) und Hash
+# des festen Präfixes aus Dokument und Anweisungen
+response_cache = OrderedDict()
+context_hash = hashlib.sha1(system_message["content"].encode()).hexdigest()
+
 # Chat-Schleife
 while True:
     try:
@@ -151,29 +323,39 @@ while True:
         print("Auf Wiedersehen!")
         break
 
-    # Prompt definieren
-    prompt = f"""
-{conversation_history}
-
-User: {user_query}
+    # Neue Nachricht an die bisherige Historie anhängen
+    user_message = {"role": "user", "content": user_query}
 
-Assistant:
-"""
+    # Bei einer wiederholten Frage zum selben Dokument die gespeicherte
+    # Antwort verwenden; der Schlüssel besteht aus Modell, Dokument-Präfix
+    # und der normalisierten Frage
+    cache_key = (args.model, context_hash, user_query.strip())
+    if cache_key in response_cache:
+        response_cache.move_to_end(cache_key)
+        assistant_response = response_cache[cache_key]
+        if args.verbose:
+            print("Antwort aus dem Cache übernommen.")
+    else:
+        # Antwort generieren
+        if args.verbose:
+            print("Generiere Antwort...")
+        try:
+            response = client.chat(
+                messages=[system_message] + list(turns) + [user_message], model=args.model,
+                options={'temperature': args.temperature}, keep_alive=KEEP_ALIVE
+            )
+            assistant_response = remove_blank_lines(response['message']['content'])
+        except Exception as e:
+            print(f"Fehler beim Generieren der Antwort: {e}")
+            continue
 
-    # Antwort generieren
-    if args.verbose:
-        print("Generiere Antwort...")
-    try:
-        response = client.generate(
-            prompt=prompt, model=args.model, options={'temperature': args.temperature}
-        )
-        assistant_response = remove_blank_lines(response['response'])
-    except Exception as e:
-        print(f"Fehler beim Generieren der Antwort: {e}")
-        continue
+        response_cache[cache_key] = assistant_response
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
 
     # Antwort ausgeben
     print(f"\n{args.model}: {assistant_response}\n")
 
     # Konversationsverlauf aktualisieren
-    conversation_history += f"\nUser: {user_query}\n\nAssistant: {assistant_response}\n"
\ No newline at end of file
+    turns.append(user_message)
+    turns.append({"role": "assistant", "content": assistant_response})
\ No newline at end of file
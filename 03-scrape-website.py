@@ -12,6 +12,8 @@ Funktionen:
 - Herunterladen von HTML-Seiten und PDF-Dateien von einer bestimmten Domain.
 - Speichern der Dateien in einem lokalen Verzeichnis mit entsprechender Ordnerstruktur.
 - Begrenzung der maximal herunterzuladenden Dateien, um die Ausführung zu kontrollieren.
+- Bedingte Requests (ETag/Last-Modified) bei erneuten Läufen, sodass unveränderte
+  Seiten und Dateien nicht erneut übertragen werden.
 - Fehlerbehandlung mit aussagekräftigen Fehlermeldungen.
 - Optionales Debugging mittels eines "verbose"-Modus, der zusätzliche Informationen
   während der Ausführung ausgibt.
@@ -22,138 +24,295 @@ Argumente zur Anpassung des Verhaltens:
 - Angabe der Start-URL der Domain.
 - Festlegung des Zielverzeichnisses zum Speichern der Dateien.
 - Begrenzung der maximalen Anzahl herunterzuladender Dateien.
+- Anzahl parallel verarbeiteter Seiten und maximale Requests pro Sekunde und Host.
 - Aktivierung des "verbose"-Modus für detaillierte Ausgaben.
 """
 
 import os
+import json
+import atexit
+import shutil
+import threading
+import time
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin, urlparse, unquote
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from functools import lru_cache
 import argparse
 
+# Zeitlimits für Verbindungsaufbau und Lesen in Sekunden
+REQUEST_TIMEOUT = (5, 30)
+
+# Bevorzugte Dateitypen, die beim Server angefragt werden
+ACCEPT_HEADER = "text/html, application/pdf;q=0.9, text/*;q=0.8"
+
+# Content-Types, deren Dateien gespeichert werden, und die zugehörigen Dateiendungen
+ALLOWED_CONTENT_TYPES = ('text', 'html', 'pdf')
+EXTENSION_MAP = (('text/html', '.html'), ('application/pdf', '.pdf'))
+
+# Gemeinsame HTTP-Session, damit Verbindungen zum selben Server
+# wiederverwendet werden (Keep-Alive)
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "rag-scraper/1.0 (+https://github.com/kinnla/rag)"
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# Name der Datei, in der ETag und Last-Modified der heruntergeladenen URLs
+# gespeichert werden, um bei erneuten Läufen bedingte Requests zu senden
+MANIFEST_NAME = ".crawl_manifest.json"
+
+# Zwischengespeichertes Zerlegen von URLs, da dieselben Links auf vielen Seiten vorkommen
+cached_urlparse = lru_cache(maxsize=4096)(urlparse)
+
+# Zeitpunkt, ab dem der nächste Request an einen Host erlaubt ist
+_next_request_time = {}
+_rate_limit_lock = threading.Lock()
+
+# Funktion zum Einhalten einer maximalen Anzahl von Requests pro Sekunde und Host
+def wait_for_host(url, rate_limit):
+    if not rate_limit:
+        return
+    host = urlparse(url).netloc
+    with _rate_limit_lock:
+        now = time.monotonic()
+        start = max(now, _next_request_time.get(host, now))
+        _next_request_time[host] = start + 1.0 / rate_limit
+    if start > now:
+        time.sleep(start - now)
+
+# Funktion zum Laden des Manifests aus dem Zielverzeichnis
+def load_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Funktion zum Speichern des Manifests im Zielverzeichnis
+def save_manifest(folder, manifest):
+    try:
+        with open(os.path.join(folder, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+    except OSError as e:
+        print(f"Fehler beim Speichern des Manifests: {e}")
+
+# Funktion zum Erstellen der Header für einen bedingten Request; nur sinnvoll,
+# wenn die lokale Kopie noch vorhanden ist
+def conditional_headers(entry):
+    headers = {"Accept": ACCEPT_HEADER}
+    if entry and os.path.exists(entry["path"]):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
 # Funktion zum Herunterladen und Speichern einer Datei oder HTML-Seite
-def download_file(url, folder, verbose=False):
+def download_file(url, folder, verbose=False, rate_limit=0, manifest=None):
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        # Überprüfe den Content-Type
-        content_type = response.headers.get('Content-Type', '').lower()
-        if not content_type:
-            raise ValueError("Konnte den Content-Type nicht bestimmen.")
-
-        # Nur bestimmte Dateien speichern
-        if not any(ct in content_type for ct in ['text', 'html', 'pdf']):
-            if verbose:
-                print(f"Datei übersprungen (Content-Type: {content_type}): {url}")
-            return False
-
-        # Bestimme die Dateiendung basierend auf dem Content-Type
-        if 'text/html' in content_type:
-            extension = ".html"
-        elif 'application/pdf' in content_type:
-            extension = ".pdf"
-        else:
-            extension = os.path.splitext(urlparse(url).path)[1]
-
-        # Bestimme den lokalen Dateinamen und den Verzeichnispfad
-        parsed_url = urlparse(url)
-        path_parts = [
-            unquote(part) for part in parsed_url.path.strip("/").split("/")
-        ]
-        if not path_parts or path_parts == ['']:
-            path_parts = ["index"]
-
-        local_filename = path_parts[-1] if path_parts[-1] else "index"
-        if not local_filename.endswith(extension):
-            local_filename += extension
-
-        # Erstelle den Verzeichnispfad
-        local_folder = os.path.join(folder, *path_parts[:-1])
-        os.makedirs(local_folder, exist_ok=True)
-
-        local_file_path = os.path.join(local_folder, local_filename)
-
-        # Überprüfen, ob die Datei bereits existiert
-        if os.path.exists(local_file_path):
-            if verbose:
-                print(f"Datei existiert bereits und wird übersprungen: {local_file_path}")
-            return False
-
-        # Datei speichern
-        with open(local_file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        entry = manifest.get(url) if manifest is not None else None
+        headers = conditional_headers(entry)
+        # Nur wenn Validatoren gesendet wurden, bedeutet eine Antwort mit 200,
+        # dass sich die Datei geändert hat
+        conditional = "If-None-Match" in headers or "If-Modified-Since" in headers
+        wait_for_host(url, rate_limit)
+        # Der Body wird erst beim Speichern gelesen; beim Verlassen des
+        # with-Blocks wird die Antwort geschlossen, sodass übersprungene
+        # Dateien nicht übertragen werden
+        with SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT,
+                         headers=headers) as response:
+            if response.status_code == 304:
+                if verbose:
+                    print(f"Datei unverändert und wird übersprungen: {url}")
+                return False
+            response.raise_for_status()
+
+            # Überprüfe den Content-Type
+            content_type = response.headers.get('Content-Type', '').lower()
+            if not content_type:
+                raise ValueError("Konnte den Content-Type nicht bestimmen.")
+
+            # Nur bestimmte Dateien speichern
+            if not any(ct in content_type for ct in ALLOWED_CONTENT_TYPES):
+                if verbose:
+                    print(f"Datei übersprungen (Content-Type: {content_type}): {url}")
+                return False
+
+            # Bestimme die Dateiendung basierend auf dem Content-Type
+            parsed_url = urlparse(url)
+            extension = next(
+                (ext for ct, ext in EXTENSION_MAP if ct in content_type),
+                os.path.splitext(parsed_url.path)[1]
+            )
+
+            # Bestimme den lokalen Dateinamen und den Verzeichnispfad
+            path_parts = [
+                unquote(part) for part in parsed_url.path.strip("/").split("/")
+            ]
+            if not path_parts or path_parts == ['']:
+                path_parts = ["index"]
+
+            local_filename = path_parts[-1] if path_parts[-1] else "index"
+            if not local_filename.endswith(extension):
+                local_filename += extension
+
+            # Erstelle den Verzeichnispfad
+            local_folder = os.path.join(folder, *path_parts[:-1])
+            os.makedirs(local_folder, exist_ok=True)
+
+            local_file_path = os.path.join(local_folder, local_filename)
+
+            # Überprüfen, ob die Datei bereits existiert; nach einem bedingten
+            # Request wurde sie geändert (sonst 304) und wird überschrieben
+            if os.path.exists(local_file_path) and not conditional:
+                if verbose:
+                    print(f"Datei existiert bereits und wird übersprungen: {local_file_path}")
+                return False
+
+            # Datei in Blöcken von 1 MB zunächst in eine temporäre Datei
+            # speichern und erst nach vollständigem Download umbenennen, damit
+            # kein abgebrochener Download als aktuelle Datei zurückbleibt
+            response.raw.decode_content = True
+            temp_file_path = local_file_path + ".part"
+            try:
+                with open(temp_file_path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+                os.replace(temp_file_path, local_file_path)
+            except BaseException:
+                if os.path.exists(temp_file_path):
+                    os.remove(temp_file_path)
+                raise
+
+            # Manifest-Eintrag für bedingte Requests in späteren Läufen; erst
+            # nach erfolgreichem Speichern, damit die Validatoren zur Datei passen
+            if manifest is not None:
+                manifest[url] = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "path": local_file_path
+                }
         print(f"Heruntergeladen: {url} als {local_file_path}")
         return True  # Erfolgreich heruntergeladen
     except Exception as e:
         print(f"Fehler beim Herunterladen der Datei {url}: {e}")
         return False  # Fehlgeschlagen
 
-# Funktion zum Abrufen aller Dateien von einer Seite
-def crawl_and_download(start_url, folder, max_files, verbose=False):
-    visited_urls = set()
-    urls_to_visit = [start_url]
-    files_downloaded = 0
-
-    base_url = f"{urlparse(start_url).scheme}://{urlparse(start_url).netloc}"
-    base_path = urlparse(start_url).path.rstrip('/')
-
-    while urls_to_visit and files_downloaded < max_files:
-        current_url = urls_to_visit.pop(0)
-        if current_url in visited_urls:
-            continue
-
-        visited_urls.add(current_url)
+# Funktion zum Abrufen aller Dateien von einer Seite; die Seiten werden von
+# mehreren Threads parallel verarbeitet, die Liste der zu besuchenden Seiten
+# wird nur vom Haupt-Thread verwaltet
+def crawl_and_download(start_url, folder, max_files, verbose=False,
+                       workers=16, rate_limit=0):
+    from selectolax.lexbor import LexborHTMLParser
 
+    visited_urls = set()
+    urls_to_visit = deque([start_url])
+    enqueued = {start_url}  # Alle jemals in die Besuchsliste aufgenommenen URLs
+
+    parsed_start_url = urlparse(start_url)
+    start_netloc = parsed_start_url.netloc
+    base_path = parsed_start_url.path.rstrip('/')
+
+    # Manifest laden und beim Beenden (auch bei Abbruch) wieder speichern
+    manifest = load_manifest(folder)
+    atexit.register(save_manifest, folder, manifest)
+
+    # Zähler für heruntergeladene und gerade laufende Downloads
+    lock = threading.Lock()
+    limit_reached = threading.Event()
+    counts = {"downloaded": 0, "in_progress": 0}
+
+    # Datei herunterladen, sofern das Limit noch nicht erreicht ist
+    def download_counted(url):
+        with lock:
+            if counts["downloaded"] + counts["in_progress"] >= max_files:
+                return False
+            counts["in_progress"] += 1
+        success = False
         try:
-            response = requests.get(current_url)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # HTML-Seite speichern
-            if download_file(current_url, folder, verbose):
-                files_downloaded += 1
-                if files_downloaded >= max_files:
-                    break
+            success = download_file(url, folder, verbose, rate_limit, manifest)
+        finally:
+            with lock:
+                counts["in_progress"] -= 1
+                if success:
+                    counts["downloaded"] += 1
+                if counts["downloaded"] >= max_files:
+                    limit_reached.set()
+        return success
+
+    # Eine Seite verarbeiten und die gefundenen HTML-Seiten zurückgeben
+    def process_page(current_url):
+        new_pages = []
+        try:
+            entry = manifest.get(current_url)
+            wait_for_host(current_url, rate_limit)
+            response = SESSION.get(current_url, timeout=REQUEST_TIMEOUT,
+                                   headers=conditional_headers(entry))
+            if response.status_code == 304:
+                # Seite unverändert: Links aus der lokalen Kopie lesen
+                with open(entry["path"], 'rb') as f:
+                    tree = LexborHTMLParser(f.read())
+            else:
+                response.raise_for_status()
+                tree = LexborHTMLParser(response.content)
+
+                # HTML-Seite speichern
+                download_counted(current_url)
 
             # Durchsuche alle Links auf der aktuellen Seite
-            for link in soup.find_all('a', href=True):
-                href = link['href']
+            for link in tree.css('a[href]'):
+                if limit_reached.is_set():
+                    break
+                href = link.attributes.get('href')
+                if not href:
+                    continue
                 file_url = urljoin(current_url, href)
-                file_extension = os.path.splitext(
-                    urlparse(file_url).path
-                )[1].lower()
-                parsed_file_url = urlparse(file_url)
+                parsed_file_url = cached_urlparse(file_url)
+                file_extension = os.path.splitext(parsed_file_url.path)[1].lower()
 
                 # Nur innerhalb der Domain und des Pfades fortfahren
-                if (parsed_file_url.netloc == urlparse(start_url).netloc and
+                if (parsed_file_url.netloc == start_netloc and
                     parsed_file_url.path.startswith(base_path)):
 
                     # PDF-Dateien herunterladen
                     if file_extension == '.pdf':
-                        if download_file(file_url, folder, verbose):
-                            files_downloaded += 1
-                            if files_downloaded >= max_files:
-                                break
+                        download_counted(file_url)
 
                     # HTML-Dateien zur Besuchsliste hinzufügen
                     elif (file_extension in ['.html', '.htm'] or not file_extension):
-                        if (file_url not in visited_urls and
-                            file_url not in urls_to_visit):
-                            urls_to_visit.append(file_url)
+                        new_pages.append(file_url)
                 elif file_extension == '.pdf':
                     # PDFs von außerhalb der Domain herunterladen
-                    if download_file(file_url, folder, verbose):
-                        files_downloaded += 1
-                        if files_downloaded >= max_files:
-                            break
+                    download_counted(file_url)
 
         except Exception as e:
             print(f"Fehler beim Abrufen von {current_url}: {e}")
-
-    print(f"{files_downloaded} Dateien erfolgreich heruntergeladen.")
+        return new_pages
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while (urls_to_visit or pending) and not limit_reached.is_set():
+            # Freie Threads mit noch nicht besuchten Seiten versorgen
+            while urls_to_visit and len(pending) < workers:
+                current_url = urls_to_visit.popleft()
+                if current_url in visited_urls:
+                    continue
+                visited_urls.add(current_url)
+                pending.add(executor.submit(process_page, current_url))
+            if not pending:
+                break
+
+            # Auf die nächste fertige Seite warten und ihre Links übernehmen
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for file_url in future.result():
+                    if file_url not in enqueued:
+                        enqueued.add(file_url)
+                        urls_to_visit.append(file_url)
+
+    print(f"{counts['downloaded']} Dateien erfolgreich heruntergeladen.")
 
 # Hauptfunktion
 def main():
@@ -176,6 +335,19 @@ def main():
         type=int,
         default=10
     )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Anzahl der parallel verarbeiteten Seiten (Standard: 16)",
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        "-r", "--rate_limit",
+        help=("Maximale Anzahl von Requests pro Sekunde und Host "
+              "(Standard: 0 = unbegrenzt)"),
+        type=float,
+        default=0
+    )
     parser.add_argument(
         "-v", "--verbose",
         help="Aktiviere detaillierte Ausgaben",
@@ -199,7 +371,8 @@ def main():
     # Starte den Crawler
     try:
         crawl_and_download(
-            args.domain, target_folder, args.max_files, args.verbose
+            args.domain, target_folder, args.max_files, args.verbose,
+            args.workers, args.rate_limit
         )
     except Exception as e:
         print(f"Fehler bei der Ausführung: {e}")
@@ -14,23 +14,31 @@ ausführliche Debugging-Informationen anzuzeigen. Das Skript richtet
 sich an Informatikschüler und Lehrkräfte, die sich mit der Verarbeitung
 von Textdaten und Suchtechnologien beschäftigen. Es demonstriert den
 Einsatz von Elasticsearch und Apache Tika zur Indexierung und Suche in
-Dokumentensammlungen.
+Dokumentensammlungen. Die Ergebnisse von Tika werden unter ~/.cache/build-index
+zwischengespeichert, sodass unveränderte Dateien bei einem erneuten Lauf nicht
+noch einmal geparst werden.
 """
 
 import os
 import sys
 import argparse
+import shelve
+import threading
 import webbrowser
-from elasticsearch import Elasticsearch
-from tika import parser as tika_parser
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from elasticsearch import Elasticsearch, helpers
 from getpass import getpass
 
 # Funktion zum Erstellen eines Elasticsearch-Clients mit optionaler Authentifizierung
 def create_es_client(hosts, username=None, password=None):
+    # Komprimierte Anfragen und ein größerer Verbindungspool, damit die
+    # parallelen Bulk-Threads nicht auf freie Verbindungen warten müssen
+    options = {"http_compress": True, "connections_per_node": 32, "request_timeout": 120}
     if username and password:
-        es = Elasticsearch(hosts=hosts, basic_auth=(username, password))
+        es = Elasticsearch(hosts=hosts, basic_auth=(username, password), **options)
     else:
-        es = Elasticsearch(hosts=hosts)
+        es = Elasticsearch(hosts=hosts, **options)
     # Verbindung testen
     try:
         if not es.ping():
@@ -55,7 +63,9 @@ def create_or_replace_index(es, index_name):
             print("Vorgang abgebrochen. Bestehender Index wird nicht geändert.")
             sys.exit(0)  # Skript beenden, da der bestehende Index nicht geändert werden soll
 
-    # Mapping definieren
+    # Mapping definieren; die Größe des Vektors kommt aus nlp_common, damit sie
+    # zum Embedding-Modell passt
+    from nlp_common import EMBEDDING_DIMS
     index_mapping = {
         "mappings": {
             "properties": {
@@ -71,7 +81,10 @@ def create_or_replace_index(es, index_name):
                 "tags": {"type": "keyword"},
                 "embedding_vector": {
                     "type": "dense_vector",
-                    "dims": 768  # Größe des Vektors, erstellt von Longformer
+                    "dims": EMBEDDING_DIMS,
+                    "element_type": "byte",  # Als int8 quantisiert gespeichert
+                    "index": True,
+                    "similarity": "cosine"
                 }
             }
         }
@@ -81,27 +94,62 @@ def create_or_replace_index(es, index_name):
     es.indices.create(index=index_name, body=index_mapping)
     print(f"Index '{index_name}' wurde erstellt.")
 
-# Allgemeine Funktion zum Indizieren eines Dokuments mit Tika
-def index_doc(es, file_path, index_name, verbose=False):
+# Verzeichnis für den Cache der Tika-Ergebnisse
+TIKA_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "build-index", "tika")
+
+# Funktion zum Parsen einer Datei mit Tika; die Datei wird im Worker-Thread
+# gelesen und als Puffer an Tika übergeben, sodass sich das Lesen der Dateien
+# über die Threads hinweg überlappt. Der Dateiname wird wie bei from_file
+# mitgeschickt, da Tika ihn zur Erkennung des Dateityps verwendet
+def parse_file(file_path):
+    from tika import parser as tika_parser
+    from tika.tika import make_content_disposition_header
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    headers = {'Content-Disposition': make_content_disposition_header(file_path)}
+    return tika_parser.from_buffer(data, headers=headers)
+
+# Funktion zum Parsen einer Datei mit Zwischenspeicher; Ergebnisse werden anhand
+# von Pfad, Änderungszeit und Größe der Datei gespeichert, sodass unveränderte
+# Dateien bei einem erneuten Lauf nicht noch einmal geparst werden
+def parse_with_cache(file_path, cache=None, cache_lock=None):
+    if cache is None:
+        return parse_file(file_path)
+
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    with cache_lock:
+        parsed = cache.get(key)
+    if parsed is None:
+        parsed = parse_file(file_path)
+        if parsed.get("status") == 200:
+            with cache_lock:
+                cache[key] = parsed
+    return parsed
+
+# Allgemeine Funktion zum Parsen eines Dokuments mit Tika; liefert die zu
+# indizierende Dokumentstruktur oder None, falls die Datei übersprungen wird
+def parse_doc(file_path, verbose=False, cache=None, cache_lock=None):
     # Tika verwenden, um das Dokument zu parsen und Inhalt sowie Metadaten zu extrahieren
     try:
-        parsed = tika_parser.from_file(file_path)
+        parsed = parse_with_cache(file_path, cache, cache_lock)
     except Exception as e:
         print(f"Fehler beim Parsen der Datei {file_path}: {e}")
-        return
+        return None
 
     content = parsed.get("content")
     if content is None:
         if verbose:
             print(f"Überspringe Datei {file_path} aufgrund fehlenden Inhalts.")
-        return
+        return None
     content = content.strip()
     content_length = len(content)
     metadata = parsed.get("metadata", {})
     directory_path = os.path.dirname(file_path)
 
     # Dokumentstruktur, die indiziert werden soll
-    doc = {
+    return {
         "file_name": os.path.basename(file_path),
         "content": content,
         "content_length": content_length,
@@ -113,27 +161,80 @@ def index_doc(es, file_path, index_name, verbose=False):
         "language": metadata.get("language", "")
     }
 
-    # Dokument direkt indizieren, ohne Pipeline
-    try:
-        es.index(index=index_name, document=doc)
-        if verbose:
-            print(f"Dokument {file_path} erfolgreich indiziert.")
-    except Exception as e:
-        print(f"Fehler beim Indizieren des Dokuments {file_path}: {e}")
-
-# Funktion zum Indizieren aller Dateien in einem Verzeichnis
-def index_files_in_directory(es, directory, index_name, verbose=False):
-    processed_files_count = 0  # Zähler für verarbeitete Dateien
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if verbose:
-                print(f"Indiziere: {file_path}")
-            try:
-                index_doc(es, file_path, index_name, verbose)
-                processed_files_count += 1  # Zähler erhöhen
-            except Exception as e:
-                print(f"Fehler beim Indizieren der Datei {file_path}: {e}")
+# Funktion zum rekursiven Auflisten aller Dateien eines Verzeichnisses; os.scandir
+# liefert die Dateitypen direkt aus dem Verzeichniseintrag, ohne zusätzliche stat-Aufrufe
+def iter_files(root):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # Versteckte Dateien (z.B. das Manifest des Web-Crawlers) überspringen
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+# Funktion zum Indizieren aller Dateien in einem Verzeichnis; die Dateien
+# werden von mehreren Threads gleichzeitig mit Tika geparst und die Dokumente
+# in Blöcken per Bulk-API an Elasticsearch gesendet
+def index_files_in_directory(es, directory, index_name, verbose=False, workers=8):
+    from tika import tika as tika_server
+
+    file_paths = list(iter_files(directory))
+    processed_files_count = len(file_paths)  # Zähler für verarbeitete Dateien
+
+    # Tika-Server einmal vorab starten, damit die Threads ihn nicht gleichzeitig
+    # starten; wie in tika selbst nur, wenn kein reiner Client-Betrieb
+    # (TIKA_CLIENT_ONLY) eingestellt ist, und mit dem Host und Port aus
+    # TIKA_SERVER_ENDPOINT
+    if not tika_server.TikaClientOnly:
+        endpoint = urlparse(tika_server.ServerEndpoint)
+        tika_server.checkTikaServer(endpoint.scheme, endpoint.hostname, endpoint.port)
+
+    # Generator, der die geparsten Dokumente in der Reihenfolge ihrer
+    # Fertigstellung als Bulk-Aktionen liefert; es sind höchstens 2 * workers
+    # Dateien gleichzeitig in Arbeit, damit das Parsen nicht beliebig weit vor
+    # dem Indizieren herläuft und der Speicherbedarf begrenzt bleibt
+    def generate_actions(executor, cache, cache_lock):
+        pending_paths = iter(file_paths)
+        futures = {}
+
+        # Nächste Datei zum Parsen einreihen, solange noch Dateien übrig sind
+        def submit_next():
+            path = next(pending_paths, None)
+            if path is not None:
+                futures[executor.submit(parse_doc, path, verbose, cache, cache_lock)] = path
+
+        for _ in range(2 * workers):
+            submit_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                submit_next()
+                if verbose:
+                    print(f"Indiziere: {path}")
+                try:
+                    doc = future.result()
+                except Exception as e:
+                    print(f"Fehler beim Parsen der Datei {path}: {e}")
+                    continue
+                if doc is not None:
+                    yield {"_index": index_name, "_source": doc}
+
+    failed_count = 0
+    os.makedirs(os.path.dirname(TIKA_CACHE_PATH), exist_ok=True)
+    cache_lock = threading.Lock()
+    with shelve.open(TIKA_CACHE_PATH) as cache, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for ok, info in helpers.parallel_bulk(
+                es, generate_actions(executor, cache, cache_lock),
+                thread_count=4, chunk_size=500, raise_on_error=False):
+            if not ok:
+                failed_count += 1
+                print(f"Fehler beim Indizieren eines Dokuments: {info}")
+    if failed_count:
+        print(f"{failed_count} Dokumente konnten nicht indiziert werden.")
     return processed_files_count  # Gesamtzahl der verarbeiteten Dateien zurückgeben
 
 if __name__ == "__main__":
@@ -141,6 +242,8 @@ if __name__ == "__main__":
     arg_parser.add_argument('directory', help='Das Verzeichnis mit den zu indizierenden Dokumenten.')
     arg_parser.add_argument('index_name', nargs='?', help='Name des Elasticsearch-Index. '
                             'Wenn nicht angegeben, wird der Verzeichnisname verwendet.')
+    arg_parser.add_argument('-w', '--workers', type=int, default=8,
+                            help='Anzahl der Dateien, die gleichzeitig geparst werden (Standard: 8).')
     arg_parser.add_argument('-v', '--verbose', action='store_true',
                             help='Aktiviere ausführliche Ausgabe für Debugging.')
     args = arg_parser.parse_args()
@@ -181,7 +284,7 @@ if __name__ == "__main__":
     # Indexierungsfunktion ausführen und Anzahl der verarbeiteten Dateien erhalten
     try:
         processed_files_count = index_files_in_directory(
-            es, doc_directory, index_name, verbose)
+            es, doc_directory, index_name, verbose, args.workers)
     except Exception as e:
         print(f"Fehler beim Indizieren der Dateien: {e}")
         sys.exit(1)
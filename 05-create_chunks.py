@@ -7,8 +7,8 @@ Dokumente sehr lang sind und in handlichere Abschnitte zerlegt werden sollen,
 beispielsweise für die Verarbeitung mit Sprachmodellen oder für detailliertere
 Analysen.
 
-Das Skript verwendet den XLM-Roberta-Tokenizer aus der Transformers-Bibliothek,
-um den Text in Tokens zu zerlegen. Anschließend werden die Tokens in Chunks
+Das Skript verwendet den Tokenizer des Embedding-Modells aus der
+Transformers-Bibliothek, um den Text in Tokens zu zerlegen. Anschließend werden die Tokens in Chunks
 einer festgelegten maximalen Länge aufgeteilt. Die Chunks werden mit relevanten
 Metadaten versehen und in einen neuen Elasticsearch-Index geschrieben.
 
@@ -18,7 +18,7 @@ Verwendung:
 Parameter:
     index_name: Name des Quell-Index in Elasticsearch.
     --max_token_length: (Optional) Maximale Anzahl von Tokens pro Chunk.
-                        Standard ist 512.
+                        Standard ist 126 (passend zur Eingabelänge des Modells).
     -v, --verbose: (Optional) Aktiviert die Ausgabe von Debugging-Informationen.
 
 Hinweise:
@@ -32,44 +32,73 @@ Hinweise:
 """
 
 from elasticsearch import Elasticsearch, helpers
-from transformers import XLMRobertaTokenizer
 from transformers import logging as transformers_logging
 import argparse
 import sys
 import getpass
 import os
+import time
 import warnings
+import numpy as np
 
 # Deaktiviert die Warnungen des Transformers-Moduls
 transformers_logging.set_verbosity_error()
 
-# Initialisiert den XLM-Roberta-Tokenizer
-tokenizer = XLMRobertaTokenizer.from_pretrained('xlm-roberta-base')
+# Gemeinsamen schnellen Tokenizer des Embedding-Modells verwenden (siehe nlp_common.py)
+from nlp_common import CHUNK_TOKEN_LENGTH, EMBEDDING_DIMS, TOKENIZER as tokenizer
 
+# Anzahl der Dokumente, die gemeinsam tokenisiert werden
+TOKENIZE_BATCH_SIZE = 64
 
-# Funktion zum Tokenisieren des Textes und Aufteilen in Chunks
-def tokenize_and_chunk(content, max_token_length=512):
+
+# Funktion zum Tokenisieren mehrerer Texte und Aufteilen in Chunks; liefert
+# für jeden Text die Liste seiner Chunks. Die Chunks werden über die
+# Zeichen-Offsets der Tokens direkt aus dem Originaltext geschnitten, statt
+# die Tokens wieder zu dekodieren
+def tokenize_and_chunk(contents, max_token_length=CHUNK_TOKEN_LENGTH):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        tokens = tokenizer.encode(content, add_special_tokens=False)
-        chunks = [tokens[i:i + max_token_length]
-                  for i in range(0, len(tokens), max_token_length)]
-        text_chunks = [
-            tokenizer.decode(chunk, clean_up_tokenization_spaces=True)
-            for chunk in chunks
-        ]
+        encodings = tokenizer(contents, add_special_tokens=False,
+                              return_offsets_mapping=True)["offset_mapping"]
+        text_chunks = []
+        for content, offsets in zip(contents, encodings):
+            if not offsets:
+                text_chunks.append([])
+                continue
+            # Start- und End-Offsets aller Chunks auf einmal bestimmen: der
+            # Start ist das erste, das Ende das letzte Token jedes Fensters
+            offsets = np.asarray(offsets)
+            token_count = len(offsets)
+            starts = offsets[::max_token_length, 0]
+            last_tokens = np.minimum(
+                np.arange(max_token_length, token_count + max_token_length, max_token_length),
+                token_count) - 1
+            ends = offsets[last_tokens, 1]
+            text_chunks.append([content[start:end]
+                                for start, end in zip(starts.tolist(), ends.tolist())])
         return text_chunks
 
 
-# Funktion zur Anzeige eines Fortschrittsbalkens
+# Mindestabstand zwischen zwei Aktualisierungen des Fortschrittsbalkens in Sekunden
+PROGRESS_INTERVAL = 0.25
+last_progress_print = 0.0
+
+
+# Funktion zur Anzeige eines Fortschrittsbalkens; die Ausgabe wird höchstens
+# alle PROGRESS_INTERVAL Sekunden aktualisiert, da Terminalausgaben teuer sind
 def print_progress(processed, total):
+    global last_progress_print
+    now = time.monotonic()
+    if now - last_progress_print < PROGRESS_INTERVAL and processed != total:
+        return
+    last_progress_print = now
+
     progress = processed / total
     bar_length = 40  # Länge des Fortschrittsbalkens
     block = int(bar_length * progress)
     progress_bar = '=' * block + '.' * (bar_length - block)
     percent = round(progress * 100, 2)
-    sys.stdout.write(f"\r[{progress_bar}] {percent}%")
-    sys.stdout.flush()
+    print(f"\r[{progress_bar}] {percent}%", end='', flush=True)
 
 
 # Funktion zum Erstellen des neuen Indexes
@@ -90,7 +119,10 @@ def create_target_index(es, target_index):
                 "tags": {"type": "keyword"},
                 "embedding_vector": {
                     "type": "dense_vector",
-                    "dims": 768
+                    "dims": EMBEDDING_DIMS,
+                    "element_type": "byte",  # Als int8 quantisiert gespeichert
+                    "index": True,
+                    "similarity": "cosine"
                 }
             }
         }
@@ -113,7 +145,7 @@ def create_target_index(es, target_index):
 
 
 # Dokumente verarbeiten und in Chunks aufteilen
-def process_documents(es, source_index, target_index, max_token_length=512,
+def process_documents(es, source_index, target_index, max_token_length=CHUNK_TOKEN_LENGTH,
                       scroll_time='30m', verbose=False):
     create_target_index(es, target_index)
 
@@ -125,8 +157,41 @@ def process_documents(es, source_index, target_index, max_token_length=512,
             scroll=scroll_time
         )
         actions = []
+        batch = []
         processed_count = 0
 
+        # Gesammelte Dokumente gemeinsam tokenisieren und ihre Chunks als
+        # Aktionen für den Zielindex anlegen
+        def chunk_batch():
+            chunk_lists = tokenize_and_chunk(
+                [doc["_source"]["content"] for doc in batch], max_token_length
+            )
+            for doc, chunks in zip(batch, chunk_lists):
+                if verbose:
+                    print(f"Dokument {doc['_id']} wurde in {len(chunks)} "
+                          "Chunks aufgeteilt.")
+
+                for i, chunk in enumerate(chunks):
+                    new_doc = {
+                        "_index": target_index,
+                        "_source": {
+                            "content": chunk,
+                            "content_length": len(chunk),
+                            "content_type": doc["_source"].get("content_type"),
+                            "author": doc["_source"].get("author"),
+                            "date": doc["_source"].get("date"),
+                            "keywords": doc["_source"].get("keywords"),
+                            "language": doc["_source"].get("language"),
+                            "title": doc["_source"].get("title"),
+                            "file_name": doc["_source"].get("file_name"),
+                            "path": doc["_source"].get("path"),
+                            "tags": doc["_source"].get("tags"),
+                            "chunk_number": i + 1
+                        }
+                    }
+                    actions.append(new_doc)
+            batch.clear()
+
         for doc in docs:
             processed_count += 1
             content = doc["_source"].get("content", "")
@@ -137,31 +202,10 @@ def process_documents(es, source_index, target_index, max_token_length=512,
                           "und wird übersprungen.")
                 continue
 
-            # Tokenisiere und erstelle Chunks
-            chunks = tokenize_and_chunk(content, max_token_length)
-            if verbose:
-                print(f"Dokument {doc['_id']} wurde in {len(chunks)} "
-                      "Chunks aufgeteilt.")
-
-            for i, chunk in enumerate(chunks):
-                new_doc = {
-                    "_index": target_index,
-                    "_source": {
-                        "content": chunk,
-                        "content_length": len(chunk),
-                        "content_type": doc["_source"].get("content_type"),
-                        "author": doc["_source"].get("author"),
-                        "date": doc["_source"].get("date"),
-                        "keywords": doc["_source"].get("keywords"),
-                        "language": doc["_source"].get("language"),
-                        "title": doc["_source"].get("title"),
-                        "file_name": doc["_source"].get("file_name"),
-                        "path": doc["_source"].get("path"),
-                        "tags": doc["_source"].get("tags"),
-                        "chunk_number": i + 1
-                    }
-                }
-                actions.append(new_doc)
+            # Dokument für die gemeinsame Tokenisierung vormerken
+            batch.append(doc)
+            if len(batch) >= TOKENIZE_BATCH_SIZE:
+                chunk_batch()
 
             # Fortschritt anzeigen
             print_progress(processed_count, total_docs)
@@ -177,6 +221,9 @@ def process_documents(es, source_index, target_index, max_token_length=512,
                     print(f"Fehler beim Schreiben von Dokumenten in den Index: {e}")
                     sys.exit(1)
 
+        if batch:
+            chunk_batch()
+
         if actions:
             try:
                 helpers.bulk(es, actions)
@@ -200,8 +247,8 @@ if __name__ == "__main__":
     )
     parser.add_argument('index', help='Name des Quell-Index in Elasticsearch.')
     parser.add_argument(
-        '--max_token_length', type=int, default=512,
-        help='Maximale Größe jedes Chunks in Tokens. Standard ist 512.'
+        '--max_token_length', type=int, default=CHUNK_TOKEN_LENGTH,
+        help=f'Maximale Größe jedes Chunks in Tokens. Standard ist {CHUNK_TOKEN_LENGTH}.'
     )
     parser.add_argument(
         '-v', '--verbose', action='store_true',
@@ -227,9 +274,11 @@ if __name__ == "__main__":
         es = Elasticsearch(
             hosts=[es_host],
             basic_auth=(es_user, es_password),
-            request_timeout=30,
+            request_timeout=120,
             max_retries=10,
-            retry_on_timeout=True
+            retry_on_timeout=True,
+            http_compress=True,  # Bulk-Anfragen komprimiert senden
+            connections_per_node=32
         )
     except Exception as e:
         print(f"Fehler beim Verbinden mit Elasticsearch: {e}")
@@ -5,19 +5,19 @@
 Beschreibung:
 Dieses Skript generiert Embedding-Vektoren für alle Dokumente in einem angegebenen
 Elasticsearch-Index und speichert diese Vektoren im jeweiligen Dokument unter dem Feld
-'embedding_vector'. Es verwendet das vortrainierte Modell 'xlm-roberta-base' von Hugging Face,
-um Texte zu repräsentieren.
+'embedding_vector'. Es verwendet das vortrainierte Satzmodell
+'paraphrase-multilingual-MiniLM-L12-v2' von Hugging Face, um Texte zu repräsentieren.
 
 Anwendung:
 - Das Skript verbindet sich mit einem Elasticsearch-Cluster und verarbeitet alle Dokumente im
   angegebenen Index.
 - Es extrahiert den Inhalt aus dem Feld 'content' jedes Dokuments.
-- Es erstellt Embeddings für den Textinhalt mit Hilfe des XLM-Roberta-Modells.
+- Es erstellt Embeddings für den Textinhalt mit Hilfe des Embedding-Modells.
 - Die generierten Embedding-Vektoren werden dem Dokument hinzugefügt und zurück in den Index
   gespeichert.
 
 Voraussetzungen:
-- Installierte Python-Pakete: elasticsearch, transformers, torch
+- Installierte Python-Pakete: elasticsearch, transformers, torch, orjson
 - Zugriff auf einen laufenden Elasticsearch-Cluster
 - Das Skript erwartet, dass die Umgebungsvariablen 'ES_USER' und 'ES_PASSWORD' gesetzt sind
   oder fordert den Benutzer zur Eingabe auf.
@@ -26,7 +26,9 @@ Weitere Hinweise:
 - Dieses Skript demonstriert den Einsatz von NLP-Modellen zur Textrepräsentation und die
   Integration mit Elasticsearch zur Speicherung und Abfrage von Daten.
 - Es zeigt, wie man mit großen Datenmengen in Elasticsearch umgeht und effiziente
-  Verarbeitungstechniken wie die Scroll-API verwendet.
+  Verarbeitungstechniken wie die Scroll-API und die Bulk-API verwendet.
+- Es werden nur Dokumente ohne Embedding verarbeitet, sodass ein abgebrochener
+  Lauf einfach neu gestartet werden kann.
 - Der Code beinhaltet auch eine Fortschrittsanzeige und Fehlerbehandlung, um den
   Verarbeitungsstatus zu überwachen.
 
@@ -41,23 +43,132 @@ Verwendung:
 import sys
 import argparse
 import getpass
+import hashlib
 import os
-from elasticsearch import Elasticsearch
-from transformers import XLMRobertaTokenizer, XLMRobertaModel
+import queue
+import threading
+import time
+from collections import OrderedDict
+import orjson
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.serializer import JSONSerializer
+from transformers import AutoModel
 import torch
+from nlp_common import MAX_SEQ_LENGTH, MODEL_NAME, TOKENIZER
+
+# Anzahl der Dokumente, die gemeinsam durch das Modell geschickt werden
+EMBEDDING_BATCH_SIZE = 32
+
+# Mindestabstand zwischen zwei Aktualisierungen des Fortschrittsbalkens in Sekunden
+PROGRESS_INTERVAL = 0.25
+
+# Höchstzahl der zwischengespeicherten Embeddings für die Erkennung doppelter
+# Inhalte (bei 384 int8-Werten je Vektor etwa 50 MB)
+EMBEDDING_CACHE_SIZE = 100000
+
+# JSON-Serializer auf Basis von orjson; kodiert die langen Zahlenlisten der
+# Embeddings deutlich schneller als das Standardmodul json und nimmt
+# NumPy-Arrays direkt entgegen
+class OrjsonSerializer(JSONSerializer):
+    def dumps(self, data):
+        # Bereits kodierte Anfragekörper unverändert weiterreichen
+        if isinstance(data, (str, bytes)):
+            return super().dumps(data)
+        return orjson.dumps(data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+# Funktion, um wiederverwendbare Eingabepuffer im gesperrten (pinned) Speicher
+# anzulegen; aus diesem Speicher kann die GPU asynchron kopieren
+def allocate_input_buffers(batch_size, max_length=MAX_SEQ_LENGTH):
+    return {key: torch.empty(batch_size * max_length, dtype=torch.long, pin_memory=True)
+            for key in ("input_ids", "attention_mask")}
+
+# Funktion, um die Eingaben auf das Gerät zu übertragen; mit Puffern werden sie
+# zuerst in den gesperrten Speicher kopiert und dann ohne Blockieren übertragen
+def move_inputs(inputs, device, buffers=None):
+    if buffers is None:
+        return {key: value.to(device) for key, value in inputs.items()}
+    moved = {}
+    for key, value in inputs.items():
+        staged = buffers[key][:value.numel()].view(value.shape).copy_(value)
+        moved[key] = staged.to(device, non_blocking=True)
+    return moved
+
+# Funktion, um Embeddings für mehrere Texte in einem Durchlauf zu berechnen
+def create_embeddings(model, tokenizer, texts, device, buffers=None):
+    inputs = tokenizer(
+        texts,
+        return_tensors="pt",
+        truncation=True,
+        padding=True,  # Nur bis zum längsten Text im Batch auffüllen
+        max_length=MAX_SEQ_LENGTH  # Eingabelänge, mit der das Modell trainiert wurde
+    )
+    inputs = move_inputs(inputs, device, buffers)
+    with torch.inference_mode():
+        outputs = model(**inputs)
+
+    # Mittelwert der Token-Embeddings als finales Text-Embedding verwenden;
+    # aufgefüllte Positionen werden über die Attention-Maske ausgeblendet
+    mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+    summed = (outputs.last_hidden_state * mask).sum(dim=1)
+    embeddings = (summed / mask.sum(dim=1).clamp(min=1)).float()
+
+    # Jeden Vektor auf den Wertebereich von int8 skalieren, passend zum Feldtyp
+    # 'byte' im Index; die Kosinus-Ähnlichkeit bleibt dabei erhalten. Da die
+    # Vektoren danach unterschiedlich lang sind, verwendet der Index 'cosine'
+    # und nicht 'dot_product', das für byte-Vektoren gleiche Längen voraussetzt
+    scale = 127 / embeddings.abs().amax(dim=1, keepdim=True).clamp(min=1e-12)
+    quantized = torch.round(embeddings * scale).clamp(-128, 127).to(torch.int8)
+
+    # Als NumPy-Array zurückgeben; der orjson-Serializer schreibt die Zeilen direkt
+    return quantized.cpu().numpy()
+
+# Funktion, um gesammelte Aktualisierungen per Bulk-API zu schreiben
+def write_updates(es, actions):
+    if not actions:
+        return
+    _, errors = helpers.bulk(es, actions, chunk_size=500, raise_on_error=False)
+    for error in errors:
+        print("\nFehler beim Aktualisieren eines Dokuments:")
+        print(str(error))
 
 # Funktion, um Embeddings für alle Dokumente im Index zu generieren
-def process_documents(es, index, verbose=False):
-    # XLM-Roberta Modell und Tokenizer laden
-    tokenizer = XLMRobertaTokenizer.from_pretrained('xlm-roberta-base')
-    model = XLMRobertaModel.from_pretrained('xlm-roberta-base')
+def process_documents(es, index, verbose=False, compile_model=True):
+    # Embedding-Modell und Tokenizer laden; auf einer GPU wird das Modell in
+    # halber Genauigkeit (FP16) ausgeführt
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tokenizer = TOKENIZER  # Gemeinsamer schneller Tokenizer (siehe nlp_common.py)
+    model = AutoModel.from_pretrained(MODEL_NAME).to(device)
+    buffers = None
+    if device == "cuda":
+        model = model.half()
+        # Eingabepuffer einmal anlegen und für alle Batches wiederverwenden
+        buffers = allocate_input_buffers(EMBEDDING_BATCH_SIZE)
+    model.eval()
+
+    # Auf der GPU den Vorwärtsdurchlauf mit torch.compile übersetzen, damit
+    # Kernel zusammengefasst werden; dynamic=True, da die Batches je nach
+    # Textlänge unterschiedlich lang aufgefüllt werden. Ein Probedurchlauf löst
+    # die Übersetzung aus; schlägt sie fehl (z.B. ohne Triton), wird das Modell
+    # ohne torch.compile verwendet
+    if device == "cuda" and compile_model:
+        try:
+            compiled_model = torch.compile(model, dynamic=True)
+            create_embeddings(compiled_model, tokenizer, ["Aufwärmen des Modells"],
+                              device, buffers)
+            model = compiled_model
+        except Exception as e:
+            print(f"torch.compile nicht verfügbar, verwende das Modell ohne Übersetzung: {e}")
 
     if verbose:
-        print("Modell und Tokenizer erfolgreich geladen.")
+        print(f"Modell und Tokenizer erfolgreich geladen (Gerät: {device}).")
 
-    # Anzahl der Dokumente im Index abrufen
+    # Nur Dokumente ohne Embedding verarbeiten; so kann ein abgebrochener
+    # Lauf fortgesetzt werden, ohne bereits verarbeitete Dokumente zu wiederholen
+    query = {"query": {"bool": {"must_not": [{"exists": {"field": "embedding_vector"}}]}}}
+
+    # Anzahl der zu verarbeitenden Dokumente im Index abrufen
     try:
-        total_docs = es.count(index=index)['count']
+        total_docs = es.count(index=index, body=query)['count']
     except Exception as e:
         print("Fehler beim Abrufen der Dokumentanzahl:")
         print(str(e))
@@ -65,88 +176,161 @@ def process_documents(es, index, verbose=False):
 
     print(f"Verarbeite {total_docs} Dokumente und erstelle Embedding-Vektoren...")
 
-    # Scroll-API verwenden, um alle Dokumente des Index abzurufen
-    scroll_size = 1000  # Anzahl der Dokumente pro Abfrage
+    scroll_size = 500  # Anzahl der Dokumente pro Abfrage
     scroll_time = '60m'  # Wie lange der Scroll-Zustand aktiv bleibt
-
-    try:
-        results = es.search(
-            index=index,
-            body={"query": {"match_all": {}}, "size": scroll_size},
-            scroll=scroll_time
-        )
-    except Exception as e:
-        print("Fehler bei der Suche in Elasticsearch:")
-        print(str(e))
-        sys.exit(1)
-
-    scroll_id = results['_scroll_id']
-    documents = results['hits']['hits']
     processed_docs = 0
+    last_progress_print = 0.0
 
-    if verbose:
-        print(f"Initiale Suche abgeschlossen. Scroll-ID: {scroll_id}")
+    # Bereits berechnete Embeddings, indiziert über den Hash des Inhalts; so
+    # werden doppelte Chunks (z.B. Kopf- und Fußzeilen) nur einmal eingebettet.
+    # Die zuletzt verwendeten EMBEDDING_CACHE_SIZE Einträge bleiben erhalten
+    known_embeddings = OrderedDict()
+    duplicate_docs = 0
 
+    # Fortschrittsbalken höchstens alle PROGRESS_INTERVAL Sekunden aktualisieren,
+    # da Terminalausgaben teuer sind
     def print_progress(processed, total):
+        nonlocal last_progress_print
+        now = time.monotonic()
+        if now - last_progress_print < PROGRESS_INTERVAL and processed != total:
+            return
+        last_progress_print = now
+
         progress = processed / total
         bar_length = 40  # Länge der Fortschrittsanzeige
         block = int(bar_length * progress)
         progress_bar = '=' * block + '.' * (bar_length - block)
         percent = round(progress * 100, 2)
-        sys.stdout.write(f"\r[{progress_bar}] {percent}%")
-        sys.stdout.flush()
+        print(f"\r[{progress_bar}] {percent}%", end='', flush=True)
 
-    while len(documents) > 0:
-        for doc in documents:
-            if verbose:
-                print(f"\nVerarbeite Dokument ID: {doc['_id']}")
+    # Embeddings für eine Seite von Dokumenten erstellen und die
+    # Aktualisierungen als Bulk-Aktionen zurückgeben
+    def process_page(documents):
+        nonlocal processed_docs, duplicate_docs
 
-            # Den Content des Dokuments abrufen
+        # Dokumente ohne Inhalt überspringen, die übrigen sammeln
+        docs_with_content = []
+        for doc in documents:
             if 'content' in doc['_source']:
-                text = doc['_source']['content']
-
-                # Text tokenisieren und Embeddings erstellen
-                inputs = tokenizer(
-                    text,
-                    return_tensors="pt",
-                    truncation=True,
-                    padding="max_length",
-                    max_length=512
-                )
-                with torch.no_grad():
-                    outputs = model(**inputs)
-
-                # Mittelwert der Token-Embeddings als finales Text-Embedding verwenden
-                embedding_vector = outputs.last_hidden_state.mean(dim=1).squeeze().tolist()
-
-                # Embedding zum Dokument hinzufügen
-                doc['_source']['embedding_vector'] = embedding_vector
-
-                # Aktualisiere das Dokument im Index
-                try:
-                    es.index(index=index, id=doc['_id'], body=doc['_source'])
-                except Exception as e:
-                    print(f"\nFehler beim Aktualisieren des Dokuments ID {doc['_id']}:")
-                    print(str(e))
+                docs_with_content.append(doc)
             else:
                 if verbose:
                     print(f"Dokument ID {doc['_id']} hat kein 'content'-Feld.")
-
-            # Dokumente zählen und Fortschritt anzeigen
-            processed_docs += 1
-            print_progress(processed_docs, total_docs)
-
-        # Weitere Dokumente scannen
+                processed_docs += 1
+                print_progress(processed_docs, total_docs)
+
+        # Dokumente nach dem Hash ihres Inhalts gruppieren
+        groups = {}
+        for doc in docs_with_content:
+            content = doc['_source']['content']
+            key = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+            groups.setdefault(key, []).append(doc)
+
+        # Nur Inhalte einbetten, für die noch kein Embedding vorliegt
+        pending = [(key, docs[0]['_source']['content']) for key, docs in groups.items()
+                   if key not in known_embeddings]
+
+        # Embeddings batchweise erstellen; nach Länge sortiert, damit Texte
+        # ähnlicher Länge im selben Batch landen und wenig aufgefüllt werden muss
+        pending.sort(key=lambda item: len(item[1]))
+        for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+            batch = pending[start:start + EMBEDDING_BATCH_SIZE]
+            embedding_vectors = create_embeddings(
+                model, tokenizer, [content for _, content in batch], device, buffers
+            )
+            for (key, _), embedding_vector in zip(batch, embedding_vectors):
+                known_embeddings[key] = embedding_vector
+        duplicate_docs += len(docs_with_content) - len(pending)
+
+        # Das Embedding jedes Inhalts allen Dokumenten mit diesem Inhalt zuweisen
+        actions = []
+        for key, docs in groups.items():
+            embedding_vector = known_embeddings[key]
+            known_embeddings.move_to_end(key)
+            for doc in docs:
+                if verbose:
+                    print(f"\nVerarbeite Dokument ID: {doc['_id']}")
+
+                # Nur das Embedding-Feld des Dokuments aktualisieren
+                actions.append({
+                    "_op_type": "update",
+                    "_index": index,
+                    "_id": doc['_id'],
+                    "doc": {"embedding_vector": embedding_vector}
+                })
+
+                # Dokumente zählen und Fortschritt anzeigen
+                processed_docs += 1
+                print_progress(processed_docs, total_docs)
+
+        # Erst nach dem Zuweisen die ältesten Einträge verwerfen, damit alle
+        # Embeddings der aktuellen Seite verfügbar bleiben
+        while len(known_embeddings) > EMBEDDING_CACHE_SIZE:
+            known_embeddings.popitem(last=False)
+
+        return actions
+
+    # Die drei Schritte laufen als Pipeline gleichzeitig: ein Thread liest
+    # Dokumente aus Elasticsearch, der Haupt-Thread berechnet die Embeddings
+    # und ein weiterer Thread schreibt die Ergebnisse zurück
+    page_queue = queue.Queue(maxsize=4)
+    update_queue = queue.Queue(maxsize=4)
+    errors = []
+
+    # Dokumente per Scan-Helper abrufen; Elasticsearch liefert nur das
+    # benötigte Feld 'content'
+    def scan_documents():
         try:
-            results = es.scroll(scroll_id=scroll_id, scroll=scroll_time)
+            page = []
+            for doc in helpers.scan(es, index=index, query=query, _source=['content'],
+                                    size=scroll_size, scroll=scroll_time):
+                page.append(doc)
+                if len(page) >= scroll_size:
+                    page_queue.put(page)
+                    page = []
+            if page:
+                page_queue.put(page)
         except Exception as e:
-            print("\nFehler beim Abrufen weiterer Dokumente mit Scroll:")
-            print(str(e))
-            sys.exit(1)
+            errors.append(("Fehler beim Abrufen der Dokumente:", e))
+        finally:
+            page_queue.put(None)
+
+    # Gesammelte Aktualisierungen per Bulk-API schreiben
+    def write_documents():
+        while True:
+            actions = update_queue.get()
+            if actions is None:
+                break
+            try:
+                write_updates(es, actions)
+            except Exception as e:
+                errors.append(("Fehler beim Schreiben der Embeddings:", e))
+
+    scanner = threading.Thread(target=scan_documents, daemon=True)
+    writer = threading.Thread(target=write_documents, daemon=True)
+    scanner.start()
+    writer.start()
 
-        scroll_id = results['_scroll_id']
-        documents = results['hits']['hits']
+    try:
+        while True:
+            page = page_queue.get()
+            if page is None:
+                break
+            update_queue.put(process_page(page))
+    except Exception as e:
+        errors.append(("Fehler beim Erstellen der Embeddings:", e))
+    finally:
+        update_queue.put(None)
+        writer.join()
+
+    if errors:
+        for message, error in errors:
+            print(f"\n{message}")
+            print(str(error))
+        sys.exit(1)
 
+    if verbose:
+        print(f"\n{duplicate_docs} Dokumente mit bereits eingebettetem Inhalt übernommen.")
     print("\nAlle Dokumente erfolgreich verarbeitet.")
 
 # Skript ausführen
@@ -156,6 +340,8 @@ if __name__ == "__main__":
         description='Generiere und speichere Embedding-Vektoren für alle Dokumente in einem Elasticsearch-Index.'
     )
     parser.add_argument('index', help='Name des Elasticsearch-Index.')
+    parser.add_argument('--no_compile', action='store_true',
+                        help='Modell auf der GPU nicht mit torch.compile übersetzen.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Aktiviere ausführliche Ausgabe.')
     args = parser.parse_args()
@@ -178,9 +364,12 @@ if __name__ == "__main__":
         es = Elasticsearch(
             hosts=[es_host],
             basic_auth=(es_user, es_password),
-            request_timeout=30,  # Zeitlimit für die Anfrage auf 30 Sekunden setzen
+            request_timeout=120,  # Zeitlimit für die Anfrage auf 120 Sekunden setzen
             max_retries=10,
-            retry_on_timeout=True
+            retry_on_timeout=True,
+            http_compress=True,  # Bulk-Anfragen komprimiert senden
+            connections_per_node=32,  # Verbindungen für Scan- und Schreib-Thread
+            serializer=OrjsonSerializer()
         )
     except Exception as e:
         print("Fehler beim Verbinden mit Elasticsearch:")
@@ -200,4 +389,5 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # Dokumente verarbeiten
-    process_documents(es, args.index, verbose=args.verbose)
\ No newline at end of file
+    process_documents(es, args.index, verbose=args.verbose,
+                      compile_model=not args.no_compile)
\ No newline at end of file
@@ -12,12 +12,16 @@ Vektor umgewandelt, um relevante Dokumente aus dem Index zu finden. Anschließen
 werden diese Dokumente verwendet, um eine fundierte Antwort zu generieren.
 
 **Hauptfunktionen:**
-- Erzeugung von Embeddings der Benutzerfrage mit XLM-Roberta.
-- Suche nach relevanten Dokumenten in Elasticsearch basierend auf
-  Kosinus-Ähnlichkeit.
+- Erzeugung von Embeddings der Benutzerfrage mit demselben Satzmodell
+  (paraphrase-multilingual-MiniLM-L12-v2), mit dem die Dokumente indiziert wurden.
+- Suche nach relevanten Dokumenten in Elasticsearch per kNN-Suche basierend
+  auf Kosinus-Ähnlichkeit; kleine Indizes werden einmal in den Arbeitsspeicher
+  geladen und mit NumPy lokal durchsucht.
 - Dynamische Konstruktion des Eingabe-Prompts für das Sprachmodell unter
   Einbeziehung der gefundenen Dokumente.
-- Nutzung des Ollama-Clients zur Generierung natürlicher Antworten.
+- Nutzung des Ollama-Clients zur Generierung natürlicher Antworten; das
+  Sprachmodell wird beim Start im Hintergrund geladen, während das
+  Embedding-Modell lädt, und bleibt über keep_alive im Speicher.
 - Unterstützung eines laufenden Gesprächsverlaufs mit Kontext.
 - Möglichkeit, Debugging-Informationen mittels des Flags `-v` anzuzeigen.
 
@@ -32,55 +36,172 @@ werden diese Dokumente verwendet, um eine fundierte Antwort zu generieren.
 
 import argparse
 import getpass
-from elasticsearch import Elasticsearch
-from transformers import XLMRobertaTokenizer, XLMRobertaModel
-import torch
-import ollama
+import hashlib
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 
-# Initialisiert den Ollama-Client
-client = ollama.Client()
+# Die umfangreichen Bibliotheken (torch, transformers, elasticsearch, ollama,
+# numpy) werden erst in den Funktionen importiert, die sie benötigen; so
+# startet z.B. der Aufruf mit --help ohne spürbare Wartezeit
+
+# Wie lange Ollama das Sprachmodell nach einer Anfrage im Speicher hält
+KEEP_ALIVE = "30m"
+
+# Anzahl der Frage-Embeddings, die im Cache gehalten werden
+EMBEDDING_CACHE_SIZE = 256
+
+# Anzahl der bereinigten Dokumentinhalte, die im Cache gehalten werden
+DOCUMENT_CACHE_SIZE = 1024
+
+# Bis zu dieser Anzahl von Dokumenten wird der Index in den Arbeitsspeicher
+# geladen und lokal durchsucht (Standardwert für --local-search-limit)
+LOCAL_SEARCH_LIMIT = 50000
+
+# Anzahl der letzten Gesprächsrunden im Prompt (Standardwert für --max-turns)
+MAX_TURNS = 20
+
+# Regulärer Ausdruck für zwei oder mehr aufeinanderfolgende Zeilenumbrüche
+MULTI_NEWLINE = re.compile(r'\n{2,}')
+
+# Regulärer Ausdruck für beliebige Folgen von Leerzeichen
+WHITESPACE = re.compile(r'\s+')
 
 # Funktion zur Erstellung eines Embeddings für die Frage des Benutzers
-def create_embedding_for_question(model, tokenizer, question):
+def create_embedding_for_question(model, tokenizer, question, device="cpu"):
+    import torch
+    from nlp_common import MAX_SEQ_LENGTH
+
+    # Ohne Auffüllen tokenisieren: das Modell rechnet nur über die tatsächlichen
+    # Tokens der Frage statt über die volle Eingabelänge
     inputs = tokenizer(
         question,
         return_tensors="pt",
         truncation=True,
-        padding="max_length",
-        max_length=512
-    )  # XLM-Roberta hat eine maximale Länge von 512 Tokens
-    with torch.no_grad():
+        max_length=MAX_SEQ_LENGTH
+    )  # Das Modell wurde mit maximal 128 Tokens trainiert
+    inputs = {key: value.to(device) for key, value in inputs.items()}
+    with torch.inference_mode():
         outputs = model(**inputs)
-    return outputs.last_hidden_state.mean(dim=1).squeeze().tolist()
 
-# Funktion zum Bereinigen der Antwort durch Entfernen doppelter Zeilenumbrüche
+    # Mittelwert der Token-Embeddings wie beim Indizieren bilden; aufgefüllte
+    # Positionen werden über die Attention-Maske ausgeblendet
+    mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+    summed = (outputs.last_hidden_state * mask).sum(dim=1)
+    embedding = (summed / mask.sum(dim=1).clamp(min=1)).squeeze().float()
+
+    # Wie die Dokument-Embeddings auf int8 skalieren, da der Index die Vektoren
+    # als 'byte' speichert
+    scale = 127 / embedding.abs().max().clamp(min=1e-12)
+    return torch.round(embedding * scale).clamp(-128, 127).to(torch.int8).cpu().tolist()
+
+# Funktion zum Vereinheitlichen einer Frage für den Cache-Schlüssel: Groß- und
+# Kleinschreibung, mehrfache Leerzeichen und abschließende Satzzeichen werden
+# ignoriert, sodass z.B. "Was ist RAG?" und "was ist  rag" denselben Eintrag treffen
+def canonical_question(question):
+    return WHITESPACE.sub(" ", question.strip().casefold()).rstrip("?.! ")
+
+# Funktion, die das Embedding einer Frage aus dem Cache liefert oder es neu
+# berechnet; der Cache behält die zuletzt verwendeten Fragen (LRU)
+def cached_embedding_for_question(model, tokenizer, question, cache, device="cpu"):
+    key = hashlib.sha256(canonical_question(question).encode('utf-8')).hexdigest()[:32]
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    embedding = create_embedding_for_question(model, tokenizer, question, device)
+    cache[key] = embedding
+    if len(cache) > EMBEDDING_CACHE_SIZE:
+        cache.popitem(last=False)
+    return embedding
+
+# Funktion zum Laden aller Dokumentvektoren eines Index in eine Matrix; die
+# Zeilen werden auf Länge 1 normiert, sodass das Skalarprodukt mit einer
+# normierten Anfrage der Kosinus-Ähnlichkeit entspricht. Die Inhalte werden
+# dabei einmal bereinigt, nicht bei jeder Frage
+def load_vector_matrix(es, index_name):
+    import numpy as np
+    from elasticsearch import helpers
+
+    contents = []
+    vectors = []
+    for hit in helpers.scan(
+            es, index=index_name,
+            query={"query": {"exists": {"field": "embedding_vector"}}},
+            _source=["content", "embedding_vector"]):
+        contents.append(clean_document(hit['_source'].get('content', '')))
+        vectors.append(hit['_source']['embedding_vector'])
+    if not vectors:
+        return contents, None
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return contents, matrix
+
+# Funktion zur lokalen Suche der ähnlichsten Dokumente; eine einzige
+# Matrix-Vektor-Multiplikation bewertet alle Dokumente auf einmal
+def search_local(matrix, contents, query_vector, doc_limit):
+    import numpy as np
+
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(np.linalg.norm(query), 1e-12)
+    scores = matrix @ query
+    k = min(doc_limit, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [contents[i] for i in top]
+
+# Funktion zum Bereinigen der Antwort durch Zusammenfassen mehrfacher Zeilenumbrüche
 def clean_response(response):
-    return response.replace("\n\n", "\n")
+    return MULTI_NEWLINE.sub("\n", response)
 
-# Funktion zum Bereinigen des Dokuments durch Entfernen doppelter Zeilenumbrüche
+# Funktion zum Bereinigen des Dokuments durch Zusammenfassen mehrfacher Zeilenumbrüche
 def clean_document(document):
-    return document.replace("\n\n", "\n")
+    return MULTI_NEWLINE.sub("\n", document)
+
+# Funktion, die den bereinigten Inhalt eines Treffers aus dem Cache liefert
+# oder ihn einmal bereinigt; Schlüssel ist die Dokument-ID (LRU)
+def cached_document(hit, cache):
+    doc_id = hit['_id']
+    if doc_id in cache:
+        cache.move_to_end(doc_id)
+        return cache[doc_id]
+    document = clean_document(hit['_source'].get('content', ''))
+    cache[doc_id] = document
+    if len(cache) > DOCUMENT_CACHE_SIZE:
+        cache.popitem(last=False)
+    return document
 
 # Hauptfunktion
 def main(index_name, system_prompt, welcome_message, user_prefix,
-         bot_prefix, doc_limit, verbose):
-
-    # Vordefinieren des Modells durch Senden einer leeren Anfrage
+         bot_prefix, doc_limit, verbose, compile_model=True,
+         local_search_limit=LOCAL_SEARCH_LIMIT, max_turns=MAX_TURNS):
+    import ollama
+    import torch
+    from elasticsearch import Elasticsearch
+    from transformers import AutoModel
+
+    # Initialisiert den Ollama-Client; er wird für alle Anfragen wiederverwendet
+    # und hält die HTTP-Verbindung zu Ollama offen (Keep-Alive)
+    client = ollama.Client()
+
+    # Thread, um das Sprachmodell beim Start im Hintergrund zu laden
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    # Vordefinieren des Modells durch Senden einer leeren Anfrage; die Anfrage
+    # läuft im Hintergrund, während das Embedding-Modell geladen wird
     print(f"Das Chatten mit llama3.1 wird vorbereitet, unterstützt durch "
-          f"den Dokumentenindex '{index_name}' und xlm-roberta-base. "
+          f"den Dokumentenindex '{index_name}' und paraphrase-multilingual-MiniLM-L12-v2. "
           "Während die Modelle laden, lesen Sie diese Nachricht.")
-    try:
-        response = client.generate(model="llama3.1")
-    except Exception as e:
-        print(f"Fehler beim Laden des Modells: {e}")
-        return
+    preload_future = executor.submit(client.generate, model="llama3.1",
+                                     keep_alive=KEEP_ALIVE)
 
-    if verbose:
-        print("Modelle erfolgreich geladen.")
-
-    # Initialisieren des Gesprächsverlaufs mit dem System-Prompt
-    conversation_history = system_prompt + "\n\n"
+    # Initialisieren des Gesprächsverlaufs; die Teile werden gesammelt und erst
+    # beim Erstellen des Prompts mit Leerzeilen verbunden. Die Begrüßung bleibt
+    # fest, von den Gesprächsrunden werden nur die letzten max_turns behalten
+    # (gleitendes Fenster). Der System-Prompt wird separat übergeben
+    history_parts = []
+    turns = deque(maxlen=2 * max_turns)
 
     # Elasticsearch-Host
     es_host = "http://localhost:9200"
@@ -104,109 +225,201 @@ def main(index_name, system_prompt, welcome_message, user_prefix,
         basic_auth=(es_user, es_password),
         request_timeout=30,
         max_retries=10,
-        retry_on_timeout=True
+        retry_on_timeout=True,
+        http_compress=True  # Antworten mit den Dokumentinhalten komprimiert übertragen
     )
 
-    # Laden des XLM-Roberta-Modells und Tokenizers
-    tokenizer = XLMRobertaTokenizer.from_pretrained('xlm-roberta-base')
-    model = XLMRobertaModel.from_pretrained('xlm-roberta-base')
+    # Kleine Indizes einmal vollständig laden und danach lokal durchsuchen;
+    # das spart die Anfrage an Elasticsearch bei jeder Frage
+    contents, matrix = None, None
+    try:
+        if es.count(index=index_name)['count'] <= local_search_limit:
+            contents, matrix = load_vector_matrix(es, index_name)
+            if verbose and matrix is not None:
+                print(f"{len(contents)} Dokumentvektoren für die lokale Suche geladen.")
+    except Exception as e:
+        print(f"Lokale Suche nicht verfügbar, verwende Elasticsearch: {e}")
+        contents, matrix = None, None
+
+    # Laden des Embedding-Modells und des gemeinsamen Tokenizers; es muss
+    # dasselbe Modell sein, mit dem die Dokumente indiziert wurden
+    from nlp_common import MODEL_NAME, TOKENIZER as tokenizer
+
+    # Modell auf der GPU (CUDA oder Apple MPS) ausführen, falls vorhanden
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        device = "cpu"
+
+    # In halber Genauigkeit laden (GPU: float16, CPU: bfloat16): halbiert den
+    # Speicherbedarf und beschleunigt die Matrixmultiplikationen; für das auf
+    # int8 skalierte Embedding genügt diese Genauigkeit. Auf der CPU nur, wenn
+    # sie bfloat16 direkt unterstützt (AVX512-BF16 oder AMX), da PyTorch sonst
+    # langsame Ersatz-Kernel verwendet und float32 schneller ist
+    if device == "cpu":
+        cpu_bf16 = any(getattr(torch.cpu, check, lambda: False)()
+                       for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"))
+        dtype = torch.bfloat16 if cpu_bf16 else torch.float32
+    else:
+        dtype = torch.float16
+    model = AutoModel.from_pretrained(MODEL_NAME, torch_dtype=dtype).to(device).eval()
+
+    # Aufwärmdurchläufe, damit die erste Frage nicht auf die Initialisierung
+    # wartet; der erste übersetzt bzw. initialisiert die Kernel, der zweite
+    # nutzt das Ergebnis
+    def warm_up(model, runs):
+        for _ in range(runs):
+            create_embedding_for_question(model, tokenizer, "Aufwärmen des Modells", device)
+
+    # Vorwärtsdurchlauf mit torch.compile übersetzen (dynamic=True, da jede
+    # Frage eine andere Länge hat; auf MPS nicht unterstützt). Schlägt die
+    # Übersetzung fehl, z.B. ohne C++-Compiler, wird das Modell ohne
+    # torch.compile verwendet
+    if compile_model and device != "mps":
+        try:
+            compiled_model = torch.compile(model, dynamic=True)
+            warm_up(compiled_model, 2)
+            model = compiled_model
+        except Exception as e:
+            print(f"torch.compile nicht verfügbar, verwende das Modell ohne Übersetzung: {e}")
+            warm_up(model, 1 if device == "cpu" else 2)
+    else:
+        warm_up(model, 1 if device == "cpu" else 2)
 
     if verbose:
-        print("XLM-Roberta-Modell und Tokenizer erfolgreich geladen.")
+        print(f"Embedding-Modell und Tokenizer erfolgreich geladen (Gerät: {device}).")
+
+    # Auf das Laden des Sprachmodells warten
+    try:
+        preload_future.result()
+    except Exception as e:
+        print(f"Fehler beim Laden des Modells: {e}")
+        return
+
+    if verbose:
+        print("Modelle erfolgreich geladen.")
 
     # Willkommensnachricht ausgeben
     print("\n" + bot_prefix + welcome_message + "\n")
-    conversation_history += bot_prefix + welcome_message + "\n\n"
+    history_parts.append(bot_prefix + welcome_message)
+
+    # Cache für die Embeddings bereits gestellter Fragen
+    embedding_cache = OrderedDict()
+
+    # Cache für die bereinigten Inhalte der Treffer aus Elasticsearch
+    document_cache = OrderedDict()
 
     while True:
         # Benutzerfrage mit user_prefix abfragen
         user_question = input(f"{user_prefix}")
-        conversation_history += user_prefix + user_question + "\n\n"
+        turns.append(user_prefix + user_question)
 
-        # Embedding für die Benutzerfrage erstellen
-        user_embedding = create_embedding_for_question(
-            model, tokenizer, user_question
+        # Embedding für die Benutzerfrage erstellen oder aus dem Cache holen; es
+        # wird direkt berechnet, da die Suche sofort darauf wartet und es keine
+        # unabhängige Arbeit gibt, mit der es sich überlappen ließe
+        user_embedding = cached_embedding_for_question(
+            model, tokenizer, user_question, embedding_cache, device
         )
 
         if verbose:
             print("Benutzer-Embedding erstellt.")
 
-        # Elasticsearch-Abfrage basierend auf Kosinus-Ähnlichkeit
-        search_query = {
-            "query": {
-                "script_score": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "script": {
-                        "source": (
-                            "cosineSimilarity(params.query_vector, "
-                            "'embedding_vector') + 1.0"
-                        ),
-                        "params": {
-                            "query_vector": user_embedding
-                        }
-                    }
-                }
-            },
-            "size": doc_limit
-        }
-
-        try:
-            es_response = es.search(index=index_name, body=search_query)
-            if verbose:
-                print(f"Elasticsearch-Antwort: {es_response}")
-        except Exception as e:
-            print(f"Fehler bei der Abfrage von Elasticsearch: {e}")
-            continue
-
-        # Dokumente aus der Antwort extrahieren
-        documents = []
-        if es_response['hits']['hits']:
-            for hit in es_response['hits']['hits']:
-                content = hit['_source'].get('content', '')
-                documents.append(clean_document(content))
+        if matrix is not None:
+            # Lokale Suche in der geladenen Vektormatrix
+            documents = search_local(matrix, contents, user_embedding, doc_limit)
+        else:
+            # kNN-Suche in Elasticsearch über den HNSW-Index des Vektorfelds
+            # (Kosinus-Ähnlichkeit laut Mapping), statt jedes Dokument einzeln
+            # zu bewerten; nur der Inhalt der Treffer wird zurückgegeben.
+            # Elasticsearch erlaubt höchstens 10000 Kandidaten
+            search_query = {
+                "knn": {
+                    "field": "embedding_vector",
+                    "query_vector": user_embedding,
+                    "k": doc_limit,
+                    "num_candidates": min(10000, max(50, 10 * doc_limit))
+                },
+                "_source": ["content"]
+            }
+
+            # filter_path lässt auch die übrigen Metadaten der Treffer (_score,
+            # _index, ...) weg, sodass nur ID und Inhalt übertragen werden
+            try:
+                es_response = es.search(index=index_name, body=search_query,
+                                        filter_path=["hits.hits._id",
+                                                     "hits.hits._source.content"])
+                if verbose:
+                    print(f"Elasticsearch-Antwort: {es_response}")
+            except Exception as e:
+                print(f"Fehler bei der Abfrage von Elasticsearch: {e}")
+                continue
+
+            # Dokumente aus der Antwort extrahieren; bereits gesehene Treffer
+            # werden nicht erneut bereinigt
+            documents = [cached_document(hit, document_cache)
+                         for hit in es_response.get('hits', {}).get('hits', [])]
+
+        if documents:
             if verbose:
                 print(f"{len(documents)} Dokumente gefunden.")
         else:
             print("Keine Dokumente gefunden.")
             continue
 
-        # Prompt für das Modell erstellen (Prompt bleibt auf Englisch)
-        prompt = conversation_history
-        prompt += "Answer the question based on the following information:\n\n"
-
-        for i, doc in enumerate(documents):
-            prompt += f"Document {i+1}:\n{doc}\n\n"
-
-        prompt += f"Here is the question again: {user_question}\n\n"
-        prompt += (
+        # Prompt für das Modell aus seinen Teilen zusammensetzen (Prompt bleibt
+        # auf Englisch); die Teile werden einmal mit Leerzeilen verbunden. Der
+        # Verlauf steht vor den Dokumenten dieser Runde, sodass Ollama den
+        # unveränderten Anfang aus der vorigen Anfrage wiederverwenden kann
+        prompt_parts = history_parts + list(turns)
+        prompt_parts.append("Answer the question based on the following information:")
+        prompt_parts.extend(f"Document {i+1}:\n{doc}" for i, doc in enumerate(documents))
+        prompt_parts.append(f"Here is the question again: {user_question}")
+        prompt_parts.append(
             "Answer the question naturally, in the user's language. "
             "If no question is asked, just keep the conversation going."
         )
+        prompt = "\n\n".join(prompt_parts)
 
         if verbose:
             print("Prompt für das Modell erstellt.")
 
-        # Antwort vom Modell generieren
+        # Antwort vom Modell generieren und Tokens direkt ausgeben, sobald sie
+        # eintreffen (Streaming)
+        print(f"\n{bot_prefix}", end="", flush=True)
+        response_parts = []
+        start_time = time.monotonic()
+        first_token_time = None
         try:
-            response = client.generate(
+            # Der System-Prompt wird als eigener, in jeder Runde identischer
+            # System-Teil übergeben und steht so immer am Anfang
+            for part in client.generate(
                 prompt=prompt,
+                system=system_prompt,
                 model="llama3.1",
-                options={'temperature': 0, 'prompt': ''}
-            )
-            if verbose:
-                print(f"Antwort vom Modell erhalten: {response}")
+                options={'temperature': 0, 'prompt': ''},
+                keep_alive=KEEP_ALIVE,
+                stream=True
+            ):
+                if first_token_time is None:
+                    first_token_time = time.monotonic()
+                print(part['response'], end="", flush=True)
+                response_parts.append(part['response'])
         except Exception as e:
-            print(f"Fehler bei der Generierung der Antwort: {e}")
+            print(f"\nFehler bei der Generierung der Antwort: {e}")
             continue
+        print("\n")
 
-        # Bereinigte Antwort des Modells anzeigen
-        if response and 'response' in response:
-            clean_resp = clean_response(response['response'])
-            # Antwort mit bot_prefix ausgeben
-            print(f"\n{bot_prefix}{clean_resp}\n")
-            conversation_history += bot_prefix + clean_resp + "\n\n"
+        if verbose and first_token_time is not None:
+            duration = time.monotonic() - first_token_time
+            print(f"Erstes Token nach {first_token_time - start_time:.2f} s, "
+                  f"{len(response_parts) / max(duration, 1e-6):.1f} Tokens/s.")
+
+        # Bereinigte Antwort des Modells in den Verlauf übernehmen
+        if response_parts:
+            clean_resp = clean_response("".join(response_parts))
+            turns.append(bot_prefix + clean_resp)
         else:
             print("Keine gültige Antwort vom Modell erhalten.")
 
@@ -249,6 +462,24 @@ if __name__ == "__main__":
         default=5,
         help="Anzahl der Dokumente im Prompt (Standard: 5)"
     )
+    parser.add_argument(
+        "--max-turns",
+        type=int,
+        default=MAX_TURNS,
+        help=f"Anzahl der letzten Gesprächsrunden im Prompt (Standard: {MAX_TURNS})"
+    )
+    parser.add_argument(
+        "--local-search-limit",
+        type=int,
+        default=LOCAL_SEARCH_LIMIT,
+        help="Indizes bis zu dieser Dokumentanzahl werden in den Arbeitsspeicher "
+             f"geladen und lokal durchsucht; 0 deaktiviert dies (Standard: {LOCAL_SEARCH_LIMIT})"
+    )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Embedding-Modell nicht mit torch.compile übersetzen."
+    )
     parser.add_argument(
         '-v', '--verbose',
         action='store_true',
@@ -263,5 +494,8 @@ if __name__ == "__main__":
         user_prefix=args.user_prefix,
         bot_prefix=args.bot_prefix,
         doc_limit=args.doc_limit,
-        verbose=args.verbose
+        verbose=args.verbose,
+        compile_model=not args.no_compile,
+        local_search_limit=args.local_search_limit,
+        max_turns=args.max_turns
     )
\ No newline at end of file
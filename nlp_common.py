@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Gemeinsame Bausteine für die Skripte, die mit dem Embedding-Modell arbeiten
+(05-create_chunks.py, 06-add-embeddings.py und 07-chat-embedding.py). Als
+Embedding-Modell dient das kompakte, mehrsprachige Satzmodell
+'paraphrase-multilingual-MiniLM-L12-v2', das aus XLM-Roberta destilliert wurde
+und Vektoren mit 384 Dimensionen liefert. Der schnelle Tokenizer des Modells
+wird beim ersten Lauf von Hugging Face geladen und im Verzeichnis models/minilm
+neben den Skripten gespeichert; spätere Läufe laden ihn direkt von dort, ohne
+Netzwerkzugriff.
+"""
+
+import os
+from transformers import AutoTokenizer
+
+# Name des Modells auf Hugging Face, Größe seiner Vektoren und lokales
+# Verzeichnis für den Tokenizer
+MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+EMBEDDING_DIMS = 384
+LOCAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'minilm')
+
+# Das Modell wurde mit höchstens 128 Tokens (einschließlich der Sondertokens
+# <s> und </s>) trainiert; längere Eingaben werden abgeschnitten. Chunks sind
+# daher standardmäßig so lang, dass sie samt Sondertokens hineinpassen
+MAX_SEQ_LENGTH = 128
+CHUNK_TOKEN_LENGTH = MAX_SEQ_LENGTH - 2
+
+# Funktion zum Laden des Tokenizers; liegt noch keine lokale Kopie vor, wird
+# er heruntergeladen und für die nächsten Läufe gespeichert. Es muss die
+# schnelle Rust-Variante sein, da nur sie die Zeichen-Offsets liefert
+def load_tokenizer():
+    if os.path.isdir(LOCAL_PATH):
+        tokenizer = AutoTokenizer.from_pretrained(LOCAL_PATH)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        tokenizer.save_pretrained(LOCAL_PATH)
+    if not tokenizer.is_fast:
+        raise RuntimeError(
+            f"Für {MODEL_NAME} ist kein schneller Tokenizer verfügbar. "
+            "Bitte das Paket 'tokenizers' installieren.")
+    return tokenizer
+
+# Gemeinsam genutzte Instanz des (in Rust implementierten) schnellen Tokenizers
+TOKENIZER = load_tokenizer()